@@ -0,0 +1,101 @@
+"""Adding instructions to ai prompt
+
+Revision ID: 0c6d4a8e2f51
+Revises: f3b9d2a6c814
+Create Date: 2026-10-18 15:47:21.604318
+
+"""
+import re
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0c6d4a8e2f51'
+down_revision: Union[str, None] = 'f3b9d2a6c814'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# The templates as seeded in cf30951c9c12, since the split can't be undone by joining the parts:
+# the seeded instructions continue after the task line
+SEEDED_TEMPLATES = {
+    'Action Plan': '''You are a highly organized and detail-oriented assistant. Your goal is to break down the task into smaller, actionable steps and organize them into a logical sequence. 
+
+Task: "{task_description}"
+
+Provide a step-by-step action plan to accomplish this task effectively.
+
+Return your response as markdown.
+''',
+    'Motivation': '''You are a motivational coach helping someone complete an important task. Your goal is to inspire and encourage them by highlighting the significance of the task, offering practical guidance for starting, and boosting their confidence.
+
+Task: "{task_description}"
+
+Provide a motivational message that includes:
+1. Why this task is important or beneficial.
+2. A simple first step to get started.
+3. Encouraging words to help them stay focused and positive.
+
+Return your response as markdown.
+''',
+    'Related Tasks': '''You are a smart assistant helping someone plan comprehensively for a task. Your goal is to suggest related or dependent tasks that will help them fully prepare or execute the primary task.
+
+Task: "{task_description}"
+
+Return your response as a JSON object with a list of related tasks. Each task should have a clear and concise description. Here is the required format:
+
+{
+  "tasks": [
+    {"description": "Task description goes here"},
+    {"description": "Second task description goes here"},
+    {"description": "Third task description goes here"}
+  ]
+}
+
+''',
+}
+TASK_LINE = 'Task: "{task_description}"'
+
+
+def upgrade() -> None:
+    op.add_column('ai_prompts', sa.Column('instructions', sa.String(), nullable=True))
+    # Move everything but the task line of the seeded prompts into the cacheable instructions
+    op.execute(r"""
+        UPDATE ai_prompts
+        SET instructions = btrim(regexp_replace(prompt_template, '\s*Task: "\{task_description\}"\s*', E'\n\n'), E' \n'),
+            prompt_template = 'Task: "{task_description}"'
+        WHERE prompt_template LIKE '%Task: "{task_description}"%'
+    """)
+
+
+def downgrade() -> None:
+    ai_prompts = sa.table(
+        'ai_prompts',
+        sa.column('name', sa.String()),
+        sa.column('prompt_template', sa.String()),
+        sa.column('instructions', sa.String()),
+    )
+    # Seeded prompts get their original template back, unless they were edited since the upgrade
+    for name, template in SEEDED_TEMPLATES.items():
+        op.execute(
+            ai_prompts.update()
+            .where(
+                ai_prompts.c.name == name,
+                ai_prompts.c.prompt_template == TASK_LINE,
+                ai_prompts.c.instructions == split_instructions(template),
+            )
+            .values(prompt_template=template, instructions=None)
+        )
+    op.execute(r"""
+        UPDATE ai_prompts
+        SET prompt_template = instructions || E'\n\n' || prompt_template
+        WHERE instructions IS NOT NULL
+    """)
+    op.drop_column('ai_prompts', 'instructions')
+
+
+def split_instructions(template: str) -> str:
+    # What the upgrade's UPDATE leaves in instructions
+    return re.sub(r'\s*Task: "\{task_description\}"\s*', '\n\n', template, count=1).strip(' \n')
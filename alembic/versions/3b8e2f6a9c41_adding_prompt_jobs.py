@@ -0,0 +1,47 @@
+"""Adding prompt jobs
+
+Revision ID: 3b8e2f6a9c41
+Revises: cf30951c9c12
+Create Date: 2026-10-18 09:02:11.418266
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3b8e2f6a9c41'
+down_revision: Union[str, None] = 'cf30951c9c12'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('prompt_jobs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('task_id', sa.Integer(), nullable=False),
+    sa.Column('ai_prompt_id', sa.Integer(), nullable=False),
+    sa.Column('status', sa.String(), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('error', sa.String(), nullable=True),
+    sa.Column('task_prompt_id', sa.Integer(), nullable=True),
+    sa.Column('date_added', sa.DateTime(), server_default=sa.text('NOW()'), nullable=False),
+    sa.Column('date_started', sa.DateTime(), nullable=True),
+    sa.Column('date_completed', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['ai_prompt_id'], ['ai_prompts.id'], ),
+    sa.ForeignKeyConstraint(['task_id'], ['tasks.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['task_prompt_id'], ['task_prompts.id'], ondelete='SET NULL'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_prompt_jobs_id'), 'prompt_jobs', ['id'], unique=False)
+    op.create_index('ix_prompt_jobs_pending', 'prompt_jobs', ['id'], unique=False, postgresql_where=sa.text("status IN ('queued', 'running')"))
+
+
+def downgrade() -> None:
+    op.drop_index('ix_prompt_jobs_pending', table_name='prompt_jobs', postgresql_where=sa.text("status IN ('queued', 'running')"))
+    op.drop_index(op.f('ix_prompt_jobs_id'), table_name='prompt_jobs')
+    op.drop_table('prompt_jobs')
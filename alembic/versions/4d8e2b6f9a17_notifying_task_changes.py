@@ -0,0 +1,40 @@
+"""Notifying task changes
+
+Revision ID: 4d8e2b6f9a17
+Revises: 9b4f1e6d2a85
+Create Date: 2026-10-18 18:12:05.317842
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '4d8e2b6f9a17'
+down_revision: Union[str, None] = '9b4f1e6d2a85'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Sent on commit, as "<user id>:<task version>", to the processes streaming events (see app.lib.events)
+    op.execute("""
+        CREATE FUNCTION notify_task_version() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('task_events', NEW.id || ':' || NEW.task_version);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER users_task_version AFTER UPDATE OF task_version ON users
+        FOR EACH ROW WHEN (NEW.task_version IS DISTINCT FROM OLD.task_version)
+        EXECUTE FUNCTION notify_task_version()
+    """)
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER users_task_version ON users")
+    op.execute("DROP FUNCTION notify_task_version()")
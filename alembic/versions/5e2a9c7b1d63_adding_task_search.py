@@ -0,0 +1,42 @@
+"""Adding task search
+
+Revision ID: 5e2a9c7b1d63
+Revises: 0c6d4a8e2f51
+Create Date: 2026-10-18 16:52:10.517834
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5e2a9c7b1d63'
+down_revision: Union[str, None] = '0c6d4a8e2f51'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# (name, columns, options); btree_gin lets owner_id lead both indexes, so a search only reads one user's entries
+INDEXES = [
+    ('ix_tasks_owner_id_search_vector', ['owner_id', 'search_vector'], {'postgresql_using': 'gin'}),
+    ('ix_tasks_owner_id_description_trgm', ['owner_id', 'description'], {'postgresql_using': 'gin', 'postgresql_ops': {'description': 'gin_trgm_ops'}}),
+]
+
+
+def upgrade() -> None:
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.execute('CREATE EXTENSION IF NOT EXISTS btree_gin')
+    # Rewrites the table to fill in the column
+    op.add_column('tasks', sa.Column('search_vector', postgresql.TSVECTOR(), sa.Computed("to_tsvector('english', coalesce(description, ''))", persisted=True)))
+    with op.get_context().autocommit_block():
+        for name, columns, options in INDEXES:
+            op.create_index(name, 'tasks', columns, unique=False, postgresql_concurrently=True, if_not_exists=True, **options)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, _, _ in reversed(INDEXES):
+            op.drop_index(name, table_name='tasks', postgresql_concurrently=True, if_exists=True)
+    op.drop_column('tasks', 'search_vector')
@@ -0,0 +1,33 @@
+"""Adding llm cache
+
+Revision ID: 7d1c4e5a2b90
+Revises: 3b8e2f6a9c41
+Create Date: 2026-10-18 10:41:37.092514
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7d1c4e5a2b90'
+down_revision: Union[str, None] = '3b8e2f6a9c41'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('llm_cache',
+    sa.Column('key', sa.String(), nullable=False),
+    sa.Column('result', sa.String(), nullable=False),
+    sa.Column('date_added', sa.DateTime(), server_default=sa.text('NOW()'), nullable=False),
+    sa.PrimaryKeyConstraint('key')
+    )
+    op.add_column('ai_prompts', sa.Column('cacheable', sa.Boolean(), server_default=sa.text('true'), nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_column('ai_prompts', 'cacheable')
+    op.drop_table('llm_cache')
@@ -0,0 +1,93 @@
+"""Adding change versions
+
+Revision ID: 9b4f1e6d2a85
+Revises: 5e2a9c7b1d63
+Create Date: 2026-10-18 17:38:44.902165
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9b4f1e6d2a85'
+down_revision: Union[str, None] = '5e2a9c7b1d63'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+NEXT_VERSION = sa.text("nextval('change_version_seq')")
+
+# (name, table, columns)
+INDEXES = [
+    ('ix_tasks_owner_id_version', 'tasks', ['owner_id', 'version']),
+    ('ix_task_tombstones_owner_id_version', 'task_tombstones', ['owner_id', 'version']),
+]
+
+
+def upgrade() -> None:
+    op.execute('CREATE SEQUENCE change_version_seq')
+    # Existing rows each get their own version as the tables are rewritten
+    op.add_column('tasks', sa.Column('version', sa.BigInteger(), server_default=NEXT_VERSION, nullable=False))
+    op.add_column('task_prompts', sa.Column('version', sa.BigInteger(), server_default=NEXT_VERSION, nullable=False))
+    op.create_table('task_tombstones',
+    sa.Column('task_id', sa.Integer(), nullable=False),
+    sa.Column('owner_id', sa.Integer(), nullable=False),
+    sa.Column('version', sa.BigInteger(), server_default=NEXT_VERSION, nullable=False),
+    sa.Column('date_deleted', sa.DateTime(), server_default=sa.text('NOW()'), nullable=False),
+    sa.ForeignKeyConstraint(['owner_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('task_id')
+    )
+
+    # Versions are kept by triggers so every write counts, whichever path it takes
+    op.execute("""
+        CREATE FUNCTION bump_change_version() RETURNS trigger AS $$
+        BEGIN
+            NEW.version := nextval('change_version_seq');
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("CREATE TRIGGER tasks_change_version BEFORE UPDATE ON tasks FOR EACH ROW EXECUTE FUNCTION bump_change_version()")
+    op.execute("CREATE TRIGGER task_prompts_change_version BEFORE UPDATE ON task_prompts FOR EACH ROW EXECUTE FUNCTION bump_change_version()")
+    # A new prompt result counts as a change to its task, so syncs only need to look at changed tasks
+    op.execute("""
+        CREATE FUNCTION touch_prompt_task() RETURNS trigger AS $$
+        BEGIN
+            UPDATE tasks SET version = nextval('change_version_seq') WHERE id = NEW.task_id;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("CREATE TRIGGER task_prompts_touch_task AFTER INSERT OR UPDATE ON task_prompts FOR EACH ROW EXECUTE FUNCTION touch_prompt_task()")
+    op.execute("""
+        CREATE FUNCTION record_task_tombstone() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO task_tombstones (task_id, owner_id) VALUES (OLD.id, OLD.owner_id);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("CREATE TRIGGER tasks_tombstone AFTER DELETE ON tasks FOR EACH ROW EXECUTE FUNCTION record_task_tombstone()")
+
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, unique=False, postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
+    op.execute("DROP TRIGGER tasks_tombstone ON tasks")
+    op.execute("DROP FUNCTION record_task_tombstone()")
+    op.execute("DROP TRIGGER task_prompts_touch_task ON task_prompts")
+    op.execute("DROP FUNCTION touch_prompt_task()")
+    op.execute("DROP TRIGGER task_prompts_change_version ON task_prompts")
+    op.execute("DROP TRIGGER tasks_change_version ON tasks")
+    op.execute("DROP FUNCTION bump_change_version()")
+    op.drop_table('task_tombstones')
+    op.drop_column('task_prompts', 'version')
+    op.drop_column('tasks', 'version')
+    op.execute('DROP SEQUENCE change_version_seq')
@@ -0,0 +1,35 @@
+"""Adding credit balance to user
+
+Revision ID: a4f09d3e6b17
+Revises: 7d1c4e5a2b90
+Create Date: 2026-10-18 11:26:05.731840
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a4f09d3e6b17'
+down_revision: Union[str, None] = '7d1c4e5a2b90'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('users', sa.Column('credit_balance', sa.Integer(), server_default=sa.text('0'), nullable=False))
+    op.execute('''
+        UPDATE users SET credit_balance = ledger.total
+        FROM (SELECT user_id, SUM(amount) AS total FROM credit_transactions GROUP BY user_id) ledger
+        WHERE ledger.user_id = users.id
+    ''')
+    op.add_column('prompt_jobs', sa.Column('credit_transaction_id', sa.Integer(), nullable=True))
+    op.create_foreign_key('prompt_jobs_credit_transaction_id_fkey', 'prompt_jobs', 'credit_transactions', ['credit_transaction_id'], ['id'], ondelete='SET NULL')
+
+
+def downgrade() -> None:
+    op.drop_constraint('prompt_jobs_credit_transaction_id_fkey', 'prompt_jobs', type_='foreignkey')
+    op.drop_column('prompt_jobs', 'credit_transaction_id')
+    op.drop_column('users', 'credit_balance')
@@ -0,0 +1,50 @@
+"""Adding query indexes
+
+Revision ID: c52e8b17f3d4
+Revises: a4f09d3e6b17
+Create Date: 2026-10-18 13:08:52.264105
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c52e8b17f3d4'
+down_revision: Union[str, None] = 'a4f09d3e6b17'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+OPEN = sa.text('date_completed IS NULL')
+
+# (name, table, columns, options)
+INDEXES = [
+    ('ix_tasks_owner_id_open', 'tasks', ['owner_id', 'id'], {'postgresql_where': OPEN}),
+    ('ix_tasks_owner_id_date_due_open', 'tasks', ['owner_id', 'date_due', 'id'], {'postgresql_where': OPEN}),
+    ('ix_tasks_owner_id_date_added_open', 'tasks', ['owner_id', 'date_added', 'id'], {'postgresql_where': OPEN}),
+    ('ix_tasks_owner_id_priority_open', 'tasks', ['owner_id', sa.text('(CASE WHEN priority = 0 THEN 7 ELSE priority END)'), 'id'], {'postgresql_where': OPEN}),
+    ('ix_tasks_owner_id_location_open', 'tasks', ['owner_id', 'location'], {'postgresql_where': OPEN}),
+    ('ix_tasks_owner_id_date_completed', 'tasks', ['owner_id', 'date_completed', 'id'], {'postgresql_where': sa.text('date_completed IS NOT NULL')}),
+    ('ix_tasks_categories', 'tasks', ['categories'], {'postgresql_using': 'gin'}),
+    ('ix_task_prompts_task_id', 'task_prompts', ['task_id', 'id'], {}),
+    ('ix_credit_transactions_user_id', 'credit_transactions', ['user_id', 'id'], {}),
+    ('ix_credit_transactions_task_prompt_id', 'credit_transactions', ['task_prompt_id'], {}),
+    ('ix_prompt_jobs_task_id', 'prompt_jobs', ['task_id'], {}),
+    ('ix_prompt_jobs_task_prompt_id', 'prompt_jobs', ['task_prompt_id'], {}),
+    ('ix_prompt_jobs_credit_transaction_id', 'prompt_jobs', ['credit_transaction_id'], {}),
+]
+
+
+def upgrade() -> None:
+    # CONCURRENTLY can't run inside a transaction, but doesn't lock the tables against writes
+    with op.get_context().autocommit_block():
+        for name, table, columns, options in INDEXES:
+            op.create_index(name, table, columns, unique=False, postgresql_concurrently=True, if_not_exists=True, **options)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, _, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
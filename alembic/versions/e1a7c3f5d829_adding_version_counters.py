@@ -0,0 +1,48 @@
+"""Adding version counters
+
+Revision ID: e1a7c3f5d829
+Revises: c52e8b17f3d4
+Create Date: 2026-10-18 14:12:05.381947
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e1a7c3f5d829'
+down_revision: Union[str, None] = 'c52e8b17f3d4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('users', sa.Column('task_version', sa.BigInteger(), server_default=sa.text('0'), nullable=False))
+    op.create_table('catalog_versions',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('version', sa.BigInteger(), server_default=sa.text('0'), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.execute("INSERT INTO catalog_versions (name) VALUES ('ai_prompts')")
+    op.execute("""
+        CREATE FUNCTION bump_catalog_version() RETURNS trigger AS $$
+        BEGIN
+            UPDATE catalog_versions SET version = version + 1 WHERE name = TG_TABLE_NAME;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER ai_prompts_catalog_version
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON ai_prompts
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_catalog_version()
+    """)
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER ai_prompts_catalog_version ON ai_prompts")
+    op.execute("DROP FUNCTION bump_catalog_version()")
+    op.drop_table('catalog_versions')
+    op.drop_column('users', 'task_version')
@@ -0,0 +1,45 @@
+"""Notifying catalog changes
+
+Revision ID: f3b9d2a6c814
+Revises: e1a7c3f5d829
+Create Date: 2026-10-18 15:03:48.226170
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f3b9d2a6c814'
+down_revision: Union[str, None] = 'e1a7c3f5d829'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Sent on commit, as "<table>:<version>", to the processes caching the catalog (see app.lib.catalog)
+    op.execute("""
+        CREATE OR REPLACE FUNCTION bump_catalog_version() RETURNS trigger AS $$
+        DECLARE
+            new_version bigint;
+        BEGIN
+            UPDATE catalog_versions SET version = version + 1 WHERE name = TG_TABLE_NAME
+            RETURNING version INTO new_version;
+            PERFORM pg_notify('catalog_versions', TG_TABLE_NAME || ':' || new_version);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+
+
+def downgrade() -> None:
+    op.execute("""
+        CREATE OR REPLACE FUNCTION bump_catalog_version() RETURNS trigger AS $$
+        BEGIN
+            UPDATE catalog_versions SET version = version + 1 WHERE name = TG_TABLE_NAME;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
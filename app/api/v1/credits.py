@@ -3,9 +3,11 @@ from fastapi import APIRouter
 from typing import List, Optional
 from fastapi.params import Depends
 from pydantic import BaseModel
-from app.auth import get_current_user
-from app.database import User
-from functools import reduce
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.auth import get_current_user, CurrentUser
+from app.database import get_db, CreditTransaction
+from app.lib import credits, responses
 
 router = APIRouter()
 
@@ -24,13 +26,16 @@ class CreditBalanceResponse(BaseModel):
 
 
 @router.get("/", response_model=List[CreditResponse])
-async def read_credits(current_user: User = Depends(get_current_user)):
-    return current_user.credit_transactions
+async def read_credits(current_user: CurrentUser = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    rows = await db.execute(
+        select(*responses.response_columns(CreditResponse, CreditTransaction))
+        .where(CreditTransaction.user_id == current_user.id)
+        .order_by(CreditTransaction.id)
+    )
+    return responses.rows_response(CreditResponse, rows)
 
 @router.get("/balance", response_model=CreditBalanceResponse)
-async def get_credit_balance(current_user: User = Depends(get_current_user)):
-    transactions = current_user.credit_transactions
-    credit_total = reduce(lambda a,b: a + b.amount, transactions, 0)
+async def get_credit_balance(current_user: CurrentUser = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
     return {
-        "credit_balance": credit_total
+        "credit_balance": await credits.get_balance(db, current_user.id)
     }
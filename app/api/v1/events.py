@@ -0,0 +1,58 @@
+import asyncio
+import os
+from typing import Optional
+from fastapi import APIRouter, Header
+from fastapi.params import Depends
+from fastapi.responses import StreamingResponse
+
+from app.auth import get_streaming_user, CurrentUser
+from app.database import SessionLocal
+from app.lib import events, versions
+
+router = APIRouter()
+
+EVENTS_KEEPALIVE = float(os.getenv('EVENTS_KEEPALIVE', 15))
+
+
+@router.get("/")
+async def stream_events(last_event_id: Optional[str] = Header(None), current_user: CurrentUser = Depends(get_streaming_user)):
+    """
+    A Server-Sent Events stream of changes to the user's tasks and prompt results, to use instead
+    of polling. Each `tasks` event carries the new task version, also its event id, and is a cue to
+    fetch GET /tasks/changes. The current version is sent on connect unless the client already has
+    it (Last-Event-ID, which EventSource sends when it reconnects).
+
+    EventSource can't set headers, so the token may also be passed as `access_token`.
+    """
+    try:
+        sent = int(last_event_id) if last_event_id else None
+    except ValueError:
+        sent = None
+    return StreamingResponse(
+        event_stream(current_user.id, sent),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def event_stream(user_id: int, sent: Optional[int]):
+    # Sessions are only opened briefly, when a notification may have been missed, so an open
+    # stream doesn't hold a pooled connection
+    subscription = events.subscribe(user_id)
+    try:
+        while True:
+            subscription.changed.clear()
+            version = subscription.version
+            if version is None:
+                async with SessionLocal() as db:
+                    version = await versions.task_version(db, user_id)
+            if sent is None or version > sent:
+                sent = version
+                yield f'id: {version}\nevent: tasks\ndata: {{"version": {version}}}\n\n'
+            try:
+                await asyncio.wait_for(subscription.changed.wait(), EVENTS_KEEPALIVE)
+            except asyncio.TimeoutError:
+                # Keeps proxies from closing an idle stream
+                yield ': keepalive\n\n'
+    finally:
+        events.unsubscribe(subscription)
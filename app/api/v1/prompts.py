@@ -1,16 +1,25 @@
-from fastapi import APIRouter, HTTPException
+import json
+import logging
+import math
+import anyio
+from contextlib import aclosing
+from datetime import datetime
+from fastapi import APIRouter, HTTPException, Request, Response, status
+from fastapi.responses import StreamingResponse
 from typing import List, Optional
 from fastapi.params import Depends
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
 from app.api.v1.task_prompts import TaskPromptResponse
-from app.auth import get_current_user
-from app.database import get_db, User, Task, AIPrompt, TaskPrompt, CreditTransaction
-from functools import reduce
+from app.auth import get_current_user, CurrentUser
+from app.database import get_db, SessionLocal, Task, PromptJob
 
-from app.lib import llm
+from app.lib import catalog, credits, llm, metrics, prompting, ratelimit, resilience, versions
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
 class PromptResponse(BaseModel):
     id: int
@@ -28,23 +37,37 @@ class ApplyPromptResponse(BaseModel):
     task_prompt: Optional[TaskPromptResponse]
     credit_balance: Optional[int]
 
+class PromptJobResponse(BaseModel):
+    id: int
+    task_id: int
+    ai_prompt_id: int
+    status: str
+    error: Optional[str]
+    task_prompt: Optional[TaskPromptResponse]
+    date_added: datetime
+    date_completed: Optional[datetime]
+
+    class ConfigDict:
+        from_attributes = True
 
 
 @router.get("/", response_model=List[PromptResponse])
-async def read_prompts(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    prompts = db.query(AIPrompt).all()
-    return prompts
+async def read_prompts(request: Request, response: Response, current_user: CurrentUser = Depends(get_current_user)):
+    prompts = await catalog.get()
+    versions.check_not_modified(request, response, versions.etag('prompts', prompts.version))
+    return list(prompts.prompts.values())
 
 @router.post("/{prompt_id}/apply/{task_id}", response_model=ApplyPromptResponse)
-async def apply_prompt_to_task(prompt_id: int, task_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def apply_prompt_to_task(prompt_id: int, task_id: int, current_user: CurrentUser = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
     """
     Will invoke AI, using the specified prompt template and task to generate the prompt.
-    Requires the user to have enough credits to run the prompt. The process is:
-    - Check credit balance
+    Requires the user to have enough credits to run the prompt. Runs over the user's or the
+    prompt's rate limit get a 429, and runs when too many are already waiting on the LLM a 503,
+    both with Retry-After, as do runs while the AI service is failing. The process is:
+    - Deduct credit, if the balance allows it
     - Generate prompt
     - Invoke AI
-    - Save response
-    - Deduct credit
+    - Save response (credit is refunded if this or the previous step fails)
 
     Returns one of:
     ```
@@ -61,43 +84,208 @@ async def apply_prompt_to_task(prompt_id: int, task_id: int, current_user: User
     }
     ```
     """
-    prompt = db.query(AIPrompt).filter(AIPrompt.id == prompt_id).first()
-    if prompt is None:
-        raise HTTPException(status_code=404, detail="Prompt not found")
-    task = db.query(Task).filter(Task.id == task_id, Task.owner_id == current_user.id).first()
-    if task is None:
-        raise HTTPException(status_code=404, detail="Task not found")
+    prompt, task = await get_prompt_and_task(db, prompt_id, task_id, current_user)
+    await ratelimit.admit(current_user.id, prompt.id, 'apply')
+
+    # 1. Deduct credit
+    reservation = await credits.reserve(db, current_user.id, prompt.cost)
+    if reservation is None:
+        metrics.CREDIT_REJECTIONS.labels('apply').inc()
+        return insufficient_credits(await credits.get_balance(db, current_user.id))
+    transaction, credit_balance = reservation
+    await db.commit()
+
+    # 2. Generate the prompt
+    formatted_prompt = prompting.format_prompt(prompt, task)
 
-    transactions = current_user.credit_transactions
-    credit_total = reduce(lambda a,b: a + b.amount, transactions, 0)
-    if credit_total < prompt.cost:
-        return {
-            "success": False,
-            "message": "Insufficient credits",
-            "task_prompt": None,
-            "credit_balance": credit_total,
-        }
-
-    # 1. Generate the prompt
-    formatted_prompt = prompt.prompt_template.replace('{task_description}', task.description)
-
-    # 2. Call the LLM with the prompt
-    result = llm.invoke(formatted_prompt)
-
-    # 3. Save the response
-    task_prompt = TaskPrompt(task_id=task_id, ai_prompt_id=prompt.id, result=result)
-    db.add(task_prompt)
-    db.commit()
-    db.refresh(task_prompt)
-
-    # 4. Deduct credit
-    transaction = CreditTransaction(user_id=current_user.id, amount=-prompt.cost, task_prompt_id=task_prompt.id)
-    db.add(transaction)
-    db.commit()
+    # 3. Call the LLM with the prompt
+    metrics.current_prompt.set(prompt.name)
+    try:
+        result = await llm.ainvoke(formatted_prompt, cache=prompt.cacheable, system=prompt.instructions, queue_timeout=llm.LLM_QUEUE_TIMEOUT)
+    except BaseException as e:
+        await refund(db, transaction)
+        error = llm_error(e, 'apply')
+        if error is e:
+            raise
+        raise error from e
+
+    # 4. Save the response, which fails if the task was deleted meanwhile
+    try:
+        task_prompt = await prompting.save_result(db, prompt, task_id, result, transaction)
+    except BaseException:
+        await refund(db, transaction)
+        raise
 
     return {
         "success": True,
         "message": None,
         "task_prompt": task_prompt,
-        "credit_balance": credit_total - prompt.cost,
+        "credit_balance": credit_balance,
+    }
+
+@router.post("/{prompt_id}/apply/{task_id}/stream")
+async def stream_prompt_to_task(prompt_id: int, task_id: int, current_user: CurrentUser = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    """
+    Same as `POST /prompts/{prompt_id}/apply/{task_id}`, but streams the result as Server-Sent Events:
+    - `delta` events with `{"text": "..."}` as the response is generated
+    - a final `result` event with the same body `apply` returns
+    - an `error` event if generation fails, in which case no credits are used
+
+    Credit is deducted when the stream starts and refunded if it doesn't complete or the result
+    can't be saved. The result is only saved once the stream completes. Rate limits apply as for `apply`.
+    """
+    prompt, task = await get_prompt_and_task(db, prompt_id, task_id, current_user)
+    await ratelimit.admit(current_user.id, prompt.id, 'stream')
+    user_id = current_user.id
+    formatted_prompt = prompting.format_prompt(prompt, task)
+
+    async def events():
+        # The request's session is closed by the time the stream runs, so use a new one
+        async with SessionLocal() as stream_db:
+            reservation = await credits.reserve(stream_db, user_id, prompt.cost)
+            if reservation is None:
+                metrics.CREDIT_REJECTIONS.labels('stream').inc()
+                yield sse_event('result', insufficient_credits(await credits.get_balance(stream_db, user_id)))
+                return
+            transaction, credit_balance = reservation
+            await stream_db.commit()
+            metrics.current_prompt.set(prompt.name)
+
+            try:
+                result = await llm.get_cached(formatted_prompt, system=prompt.instructions) if prompt.cacheable else None
+                if result is not None:
+                    yield sse_event('delta', {"text": result})
+                else:
+                    cleaner = llm.ResponseCleaner()
+                    # Saved as streamed, since a fence dropped early stays dropped if the response is cut off
+                    streamed = []
+                    # Closed straight away on disconnect, to free the LLM slot without waiting for GC
+                    async with aclosing(llm.astream(formatted_prompt, system=prompt.instructions, queue_timeout=llm.LLM_QUEUE_TIMEOUT)) as stream:
+                        async for text in stream:
+                            cleaned = cleaner.feed(text)
+                            if cleaned:
+                                streamed.append(cleaned)
+                                yield sse_event('delta', {"text": cleaned})
+                    remaining = cleaner.finish()
+                    if remaining:
+                        streamed.append(remaining)
+                        yield sse_event('delta', {"text": remaining})
+                    result = ''.join(streamed)
+                    if prompt.cacheable:
+                        await llm.set_cached(formatted_prompt, result, system=prompt.instructions)
+            except Exception as e:
+                await refund(stream_db, transaction)
+                yield sse_event('error', {"message": llm_error(e, 'stream').detail})
+                return
+            except BaseException:
+                # Client went away mid-stream
+                await refund(stream_db, transaction)
+                raise
+
+            try:
+                task_prompt = await prompting.save_result(stream_db, prompt, task_id, result, transaction)
+            except Exception:
+                logger.exception('Saving the result of prompt %s for task %s failed', prompt.id, task_id)
+                await refund(stream_db, transaction)
+                yield sse_event('error', {"message": "Failed to save the response"})
+                return
+            except BaseException:
+                await refund(stream_db, transaction)
+                raise
+            yield sse_event('result', ApplyPromptResponse(
+                success=True,
+                message=None,
+                task_prompt=TaskPromptResponse.model_validate(task_prompt, from_attributes=True),
+                credit_balance=credit_balance,
+            ).model_dump(mode='json'))
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@router.post("/{prompt_id}/apply/{task_id}/jobs", response_model=PromptJobResponse, status_code=status.HTTP_202_ACCEPTED)
+async def enqueue_prompt_job(prompt_id: int, task_id: int, current_user: CurrentUser = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    """
+    Queues the prompt to be applied by a worker (see `app.worker`) and returns immediately.
+    Poll `GET /prompts/jobs/{job_id}` for the result. Rate limits apply as for `apply`, but jobs
+    wait for the LLM however busy it is.
+    """
+    prompt, task = await get_prompt_and_task(db, prompt_id, task_id, current_user)
+    # Credit is only deducted when a worker runs the job
+    if await credits.get_balance(db, current_user.id) < prompt.cost:
+        metrics.CREDIT_REJECTIONS.labels('jobs').inc()
+        raise HTTPException(status_code=status.HTTP_402_PAYMENT_REQUIRED, detail="Insufficient credits")
+    await ratelimit.admit(current_user.id, prompt.id, 'jobs', capacity=False)
+
+    job = PromptJob(user_id=current_user.id, task_id=task.id, ai_prompt_id=prompt.id, status='queued')
+    db.add(job)
+    await db.commit()
+    return await get_job(db, job.id, current_user)
+
+@router.get("/jobs/{job_id}", response_model=PromptJobResponse)
+async def read_prompt_job(job_id: int, current_user: CurrentUser = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    job = await get_job(db, job_id, current_user)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+def insufficient_credits(credit_balance: int) -> dict:
+    return {
+        "success": False,
+        "message": "Insufficient credits",
+        "task_prompt": None,
+        "credit_balance": credit_balance,
     }
+
+async def refund(db: AsyncSession, transaction):
+    """
+    Releases the credits reserved for a run that produced no result. Shielded, since it also runs
+    when the request is being cancelled, and Starlette's cancel scope would cancel it again at
+    every await.
+    """
+    with anyio.CancelScope(shield=True):
+        # Ends a failed save, which expires the reservation, so load it again. If the save was
+        # committed after all, the result is linked to it and stays paid for.
+        await db.rollback()
+        await db.refresh(transaction)
+        if transaction.task_prompt_id is not None:
+            return
+        await credits.release(db, transaction)
+        await db.commit()
+
+def llm_error(e: BaseException, endpoint: str) -> BaseException:
+    """
+    The HTTP error for a failed LLM call, or `e` itself if it wasn't a failure (like a cancellation).
+    """
+    if isinstance(e, llm.LLMOverloaded):
+        metrics.LLM_REJECTIONS.labels(endpoint, 'overloaded').inc()
+        return ratelimit.overloaded_error()
+    if isinstance(e, resilience.CircuitOpen):
+        metrics.LLM_REJECTIONS.labels(endpoint, 'circuit_open').inc()
+        return HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="The AI service is unavailable, try again later",
+            headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))},
+        )
+    if isinstance(e, Exception):
+        logger.error('LLM call for %s failed', endpoint, exc_info=e)
+        return HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail="Failed to generate a response")
+    return e
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def get_job(db: AsyncSession, job_id: int, current_user: CurrentUser) -> Optional[PromptJob]:
+    return await db.scalar(
+        select(PromptJob)
+        .options(selectinload(PromptJob.task_prompt))
+        .where(PromptJob.id == job_id, PromptJob.user_id == current_user.id)
+    )
+
+async def get_prompt_and_task(db: AsyncSession, prompt_id: int, task_id: int, current_user: CurrentUser):
+    prompt = await catalog.get_prompt(prompt_id)
+    if prompt is None:
+        raise HTTPException(status_code=404, detail="Prompt not found")
+    task = await db.scalar(select(Task).where(Task.id == task_id, Task.owner_id == current_user.id))
+    if task is None:
+        raise HTTPException(status_code=404, detail="Task not found")
+    return prompt, task
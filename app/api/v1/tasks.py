@@ -1,14 +1,18 @@
+import os
 from datetime import datetime, timezone, timedelta
-from fastapi import APIRouter, HTTPException
-from typing import List, Optional
+from fastapi import APIRouter, Body, HTTPException, Request, Response, UploadFile
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from typing import Dict, List, Optional
 from fastapi.params import Depends
 from pydantic import BaseModel
-from sqlalchemy import case
-from sqlalchemy.orm import Session
+from sqlalchemy import bindparam, case, cast, column, delete, func, insert, literal_column, or_, select, text, update, values, Integer
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.api.v1.task_prompts import TaskPromptResponse
-from app.auth import get_current_user
-from app.database import get_db, User, Task
+from app.auth import get_current_user, CurrentUser
+from app.database import get_db, Task, TaskPrompt, TaskTombstone, CreditTransaction, UTCDateTime
+from app.lib import pagination, responses, task_io, versions
+from app.lib.cache import TTLCache
 
 router = APIRouter()
 
@@ -24,86 +28,471 @@ class TaskBase(BaseModel):
 class TaskCreate(TaskBase):
     pass
 
+class TaskUpdate(TaskCreate):
+    id: int
+
+class TaskImport(TaskCreate):
+    date_added: Optional[datetime] = None
+
 class TaskResponse(TaskBase):
     id: int
 
     class ConfigDict:
         from_attributes = True
 
+class TaskChange(TaskResponse):
+    version: int
+
+class TaskPromptChange(TaskPromptResponse):
+    task_id: int
+
+class TaskChangesResponse(BaseModel):
+    version: int
+    has_more: bool
+    tasks: List[TaskChange]
+    prompts: List[TaskPromptChange]
+    deleted: List[int]
+
+class BulkTaskResult(BaseModel):
+    id: Optional[int]
+    success: bool
+    detail: Optional[str] = None
+    task: Optional[TaskResponse] = None
+
+class ImportResponse(BaseModel):
+    imported: int
+
+class TaskStatsResponse(BaseModel):
+    open: int
+    completed: int
+    overdue: int
+    today: int
+    week: int
+    high_priority: int
+    # Open tasks only, like the list filters
+    by_category: Dict[str, int]
+    by_location: Dict[str, int]
+    by_priority: Dict[int, int]
+
+BULK_LIMIT = 500
+CHANGES_LIMIT = 1000
+EXPORT_MEDIA_TYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+TASK_STATS_CACHE_TTL = float(os.getenv('TASK_STATS_CACHE_TTL', 60))
+TASK_STATS_CACHE_SIZE = int(os.getenv('TASK_STATS_CACHE_SIZE', 10000))
+# How close a word of a description must be to `q` to match, see search_filter
+SEARCH_SIMILARITY = float(os.getenv('SEARCH_SIMILARITY', 0.3))
+
+# Every count the dashboard shows, in one pass. The due-date and priority counts match what the
+# today/week/high_priority filters list. unnest fans tasks out per category, hence DISTINCT.
+TASK_STATS = text("""
+    SELECT
+        GROUPING(c.category) = 0 AS is_category,
+        GROUPING(t.location) = 0 AS is_location,
+        GROUPING(t.priority) = 0 AS is_priority,
+        c.category, t.location, t.priority,
+        count(DISTINCT t.id) FILTER (WHERE t.date_completed IS NULL) AS open,
+        count(DISTINCT t.id) FILTER (WHERE t.date_completed IS NOT NULL) AS completed,
+        count(DISTINCT t.id) FILTER (WHERE t.date_completed IS NULL AND t.date_due < :now) AS overdue,
+        count(DISTINCT t.id) FILTER (WHERE t.date_completed IS NULL AND t.date_due <= :end_of_day) AS today,
+        count(DISTINCT t.id) FILTER (WHERE t.date_completed IS NULL AND t.date_due <= :end_of_week) AS week,
+        count(DISTINCT t.id) FILTER (WHERE t.date_completed IS NULL AND t.priority > 0 AND t.priority <= 3) AS high_priority
+    FROM tasks t
+    LEFT JOIN LATERAL unnest(t.categories) AS c(category) ON true
+    WHERE t.owner_id = :owner_id
+    GROUP BY GROUPING SETS ((), (c.category), (t.location), (t.priority))
+""").bindparams(
+    bindparam('now', type_=UTCDateTime),
+    bindparam('end_of_day', type_=UTCDateTime),
+    bindparam('end_of_week', type_=UTCDateTime),
+)
+
+# (user id, task version) -> stats; a task write bumps the version, so entries only ever expire
+_stats_cache = TTLCache(TASK_STATS_CACHE_SIZE, TASK_STATS_CACHE_TTL)
+
+# Filters relative to the current day, see due_windows
+TIME_FILTERS = {'today', 'week'}
+
 SORT_KEYS = ['date_due', 'date_added', 'date_completed', 'priority']
 SORT = {
-    'priority': case((Task.priority == 0, 7), else_=Task.priority)
+    # Rendered inline so it matches the expression index on tasks
+    'priority': case((Task.priority == literal_column('0'), literal_column('7')), else_=Task.priority)
+}
+# What a cursor's sort key must decode to, so a tampered cursor is a 400 rather than a DataError
+CURSOR_KEY_TYPES = {
+    'date_due': datetime,
+    'date_added': datetime,
+    'date_completed': datetime,
+    'priority': int,
+    'rank': (int, float),
 }
 
 
 @router.get("/", response_model=List[TaskResponse])
-async def read_tasks(sort: str = '', filter_name: str = '', skip: int = 0, limit: int = 100, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    query = db.query(Task).filter(Task.owner_id == current_user.id)
-    if sort in SORT_KEYS:
-        if sort in SORT:
-            query = query.order_by(SORT[sort])
-        else:
-            query = query.order_by(getattr(Task, sort))
-    query = apply_filter(query, filter_name)
+async def read_tasks(request: Request, response: Response, sort: str = '', filter_name: str = '', q: str = '', skip: int = 0, limit: int = 100, cursor: Optional[str] = None, current_user: CurrentUser = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    """
+    Pages can be fetched with `skip`, or by passing the `X-Next-Cursor` header of the previous
+    page as `cursor`, which stays fast however deep the page is. Responses carry an ETag, and
+    `If-None-Match` gets a 304 if none of the user's tasks have changed since.
 
-    tasks = query.offset(skip).limit(limit).all()
-    return tasks
+    `q` searches task descriptions, tolerating typos, and combines with the other parameters.
+    Results are ranked best match first unless a `sort` is given.
+    """
+    version = await versions.task_version(db, current_user.id)
+    tag_parts = ['tasks', current_user.id, version]
+    if filter_name in TIME_FILTERS:
+        # The tasks these filters list change with the date, not just with writes
+        tag_parts.append(datetime.now(timezone.utc).date().isoformat())
+    versions.check_not_modified(request, response, versions.etag(*tag_parts))
+    if sort not in SORT_KEYS:
+        sort = ''
+    q = q.strip()
+    if q and not sort:
+        sort = 'rank'
+    if q:
+        await set_search_similarity(db)
+    query, sort_key = task_list_query(current_user.id, sort, filter_name, q)
+
+    if cursor:
+        try:
+            position = pagination.decode_cursor(cursor)
+            if position.get('sort') != sort or position.get('q', '') != q:
+                raise ValueError('Cursor does not match sort')
+            if not pagination.is_cursor_value(position['id'], int):
+                raise ValueError('Invalid cursor id')
+            if sort and position['key'] is not None and not pagination.is_cursor_value(position['key'], CURSOR_KEY_TYPES[sort]):
+                raise ValueError('Invalid cursor key')
+            if sort:
+                query = query.where(pagination.keyset_after(sort_key, Task.id, position['key'], position['id']))
+            else:
+                query = query.where(Task.id > position['id'])
+        except (ValueError, KeyError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    else:
+        query = query.offset(skip)
+
+    rows = (await db.execute(query.limit(limit))).all()
+    if rows and len(rows) == limit:
+        last = rows[-1]
+        response.headers['X-Next-Cursor'] = pagination.encode_cursor({'sort': sort, 'q': q, 'key': last.sort_key, 'id': last.id})
+    return responses.rows_response(TaskResponse, rows, response)
 
 @router.post("/", response_model=TaskResponse)
-async def create_task(task: TaskCreate, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def create_task(task: TaskCreate, current_user: CurrentUser = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    await versions.touch_tasks(db, current_user.id)
     db_task = Task(**task.model_dump(), owner_id=current_user.id)
     db.add(db_task)
-    db.commit()
-    db.refresh(db_task)
+    await db.commit()
+    await db.refresh(db_task)
     return db_task
 
+@router.post("/bulk", response_model=List[BulkTaskResult])
+async def create_tasks(tasks: List[TaskCreate], current_user: CurrentUser = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    """
+    Creates up to BULK_LIMIT tasks in one transaction. Results are in the same order as the request.
+    """
+    check_bulk_size(tasks)
+    if not tasks:
+        return []
+    data = [{**task.model_dump(), "owner_id": current_user.id} for task in tasks]
+    await versions.touch_tasks(db, current_user.id)
+    task_ids = (await db.scalars(insert(Task).returning(Task.id, sort_by_parameter_order=True), data)).all()
+    await db.commit()
+    return [
+        {"id": task_id, "success": True, "task": {**task.model_dump(), "id": task_id}}
+        for task_id, task in zip(task_ids, tasks)
+    ]
+
+@router.patch("/bulk", response_model=List[BulkTaskResult])
+async def update_tasks(tasks: List[TaskUpdate], current_user: CurrentUser = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    """
+    Replaces up to BULK_LIMIT tasks in a single UPDATE. Tasks that don't exist, or belong to
+    someone else, are reported as failed without affecting the rest.
+    """
+    check_bulk_size(tasks)
+    if len({task.id for task in tasks}) != len(tasks):
+        raise HTTPException(status_code=400, detail="Duplicate task ids")
+    if not tasks:
+        return []
+    fields = list(TaskCreate.model_fields)
+    changes = values(
+        column('id', Integer),
+        *(column(name, Task.__table__.c[name].type) for name in fields),
+        name='changes',
+    ).data([(task.id, *(getattr(task, name) for name in fields)) for task in tasks])
+    await versions.touch_tasks(db, current_user.id)
+    # Cast, since a column that is None in every row is sent as an untyped NULL, which Postgres takes for text
+    updated = set((await db.scalars(
+        update(Task)
+        .where(Task.id == changes.c.id, Task.owner_id == current_user.id)
+        .values({name: cast(changes.c[name], Task.__table__.c[name].type) for name in fields})
+        .returning(Task.id),
+        execution_options={"synchronize_session": False},
+    )).all())
+    # Nothing changed, so keep the version (and the ETags made from it) as it was
+    if updated:
+        await db.commit()
+    else:
+        await db.rollback()
+    return [
+        {"id": task.id, "success": True, "task": task.model_dump()} if task.id in updated
+        else {"id": task.id, "success": False, "detail": "Task not found"}
+        for task in tasks
+    ]
+
+@router.delete("/bulk", response_model=List[BulkTaskResult])
+async def delete_tasks_bulk(task_ids: List[int] = Body(...), current_user: CurrentUser = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    check_bulk_size(task_ids)
+    await versions.touch_tasks(db, current_user.id)
+    deleted = set(await delete_tasks(db, task_ids, current_user))
+    if deleted:
+        await db.commit()
+    else:
+        await db.rollback()
+    return [
+        {"id": task_id, "success": task_id in deleted, "detail": None if task_id in deleted else "Task not found"}
+        for task_id in task_ids
+    ]
+
+@router.get("/stats", response_model=TaskStatsResponse)
+async def read_task_stats(current_user: CurrentUser = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    """
+    Task counts for the dashboard. Cached per user until their tasks change, or for at most
+    TASK_STATS_CACHE_TTL seconds as the due-date counts move with time.
+    """
+    key = (current_user.id, await versions.task_version(db, current_user.id))
+    stats = _stats_cache.get(key)
+    if stats is None:
+        stats = await task_stats(db, current_user.id)
+        _stats_cache.set(key, stats)
+    return stats
+
+@router.get("/changes", response_model=TaskChangesResponse)
+async def read_task_changes(since: int = 0, limit: int = CHANGES_LIMIT, current_user: CurrentUser = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    """
+    Everything that changed since `since`: tasks created or updated (completed ones included),
+    the new or changed prompt results of those tasks, and the ids of deleted tasks. Pass the
+    returned `version` as `since` next time, straight away while `has_more` is set. Start from 0.
+    """
+    limit = max(1, min(limit, CHANGES_LIMIT))
+    # Every query reads the same snapshot. Otherwise a write committing between the tasks and the
+    # tombstones query could be missed by the first while the second moves `version` past it.
+    # Authentication may have begun a transaction at the default level already, so end it first.
+    await db.rollback()
+    await db.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+    tasks = (await db.execute(
+        select(*responses.response_columns(TaskChange, Task))
+        .where(Task.owner_id == current_user.id, Task.version > since)
+        .order_by(Task.version)
+        .limit(limit)
+    )).all()
+    deleted = (await db.execute(
+        select(TaskTombstone.task_id, TaskTombstone.version)
+        .where(TaskTombstone.owner_id == current_user.id, TaskTombstone.version > since)
+        .order_by(TaskTombstone.version)
+        .limit(limit)
+    )).all()
+
+    # A full page may have more behind it, so stop at the end of the shortest full page.
+    # Anything past that is sent again next time, which is harmless.
+    full = [page[-1].version for page in (tasks, deleted) if len(page) == limit]
+    if full:
+        version = min(full)
+        tasks = [row for row in tasks if row.version <= version]
+        deleted = [row for row in deleted if row.version <= version]
+    else:
+        version = max([since] + [row.version for row in tasks] + [row.version for row in deleted])
+
+    # Prompt results bump their task's version, so only the tasks in this page need looking at
+    prompts = []
+    if tasks:
+        prompts = (await db.execute(
+            select(*responses.response_columns(TaskPromptChange, TaskPrompt))
+            .where(TaskPrompt.task_id.in_([row.id for row in tasks]), TaskPrompt.version > since)
+            .order_by(TaskPrompt.id)
+        )).all()
+    return ORJSONResponse({
+        "version": version,
+        "has_more": bool(full),
+        "tasks": responses.row_dicts(TaskChange, tasks),
+        "prompts": responses.row_dicts(TaskPromptChange, prompts),
+        "deleted": [row.task_id for row in deleted],
+    })
+
+@router.get("/export")
+async def export_tasks(format: str = 'ndjson', current_user: CurrentUser = Depends(get_current_user)):
+    """
+    Streams every task, completed ones included, as NDJSON or CSV.
+    """
+    if format not in EXPORT_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="Format must be ndjson or csv")
+    return StreamingResponse(
+        task_io.export_tasks(current_user.id, format),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="tasks.{format}"'},
+    )
+
+@router.post("/import", response_model=ImportResponse)
+async def import_tasks(file: UploadFile, format: Optional[str] = None, current_user: CurrentUser = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    """
+    Adds the tasks in an NDJSON or CSV file, in the same layout as the export. The format is taken
+    from the file name unless given. Nothing is imported if any row is invalid.
+    """
+    if format is None:
+        format = 'csv' if (file.filename or '').lower().endswith('.csv') else 'ndjson'
+    if format not in EXPORT_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="Format must be ndjson or csv")
+    try:
+        imported = await task_io.import_tasks(db, current_user.id, file.file, format, TaskImport)
+    except task_io.TaskImportError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if imported:
+        await db.commit()
+    else:
+        await db.rollback()
+    return {"imported": imported}
+
 @router.get("/{task_id}", response_model=TaskResponse)
-async def read_task(task_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    task = db.query(Task).filter(Task.id == task_id, Task.owner_id == current_user.id).first()
-    if task is None:
-        raise HTTPException(status_code=404, detail="Task not found")
-    return task
+async def read_task(task_id: int, current_user: CurrentUser = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    return await get_task(db, task_id, current_user)
 
 @router.get("/{task_id}/prompts", response_model=List[TaskPromptResponse])
-async def read_task_prompts(task_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    task = db.query(Task).filter(Task.id == task_id, Task.owner_id == current_user.id).first()
-    if task is None:
-        raise HTTPException(status_code=404, detail="Task not found")
-    return task.prompts
+async def read_task_prompts(task_id: int, request: Request, response: Response, current_user: CurrentUser = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    # Prompt results bump the task version too. A matching ETag can only have come from an
+    # earlier response to this user, so the ownership check can wait until after it.
+    version = await versions.task_version(db, current_user.id)
+    versions.check_not_modified(request, response, versions.etag('tasks', current_user.id, version))
+    await get_task(db, task_id, current_user)
+    rows = await db.execute(
+        select(*responses.response_columns(TaskPromptResponse, TaskPrompt)).where(TaskPrompt.task_id == task_id).order_by(TaskPrompt.id)
+    )
+    return responses.rows_response(TaskPromptResponse, rows, response)
 
 @router.put("/{task_id}", response_model=TaskResponse)
-async def update_task(task_id: int, task: TaskCreate, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    db_task = db.query(Task).filter(Task.id == task_id, Task.owner_id == current_user.id).first()
-    if db_task is None:
-        raise HTTPException(status_code=404, detail="Task not found")
+async def update_task(task_id: int, task: TaskCreate, current_user: CurrentUser = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    await versions.touch_tasks(db, current_user.id)
+    db_task = await get_task(db, task_id, current_user)
     for key, value in task.model_dump().items():
         setattr(db_task, key, value)
-    db.commit()
-    db.refresh(db_task)
+    await db.commit()
+    await db.refresh(db_task)
     return db_task
 
 @router.delete("/{task_id}")
-async def delete_task(task_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    db_task = db.query(Task).filter(Task.id == task_id, Task.owner_id == current_user.id).first()
-    if db_task is None:
+async def delete_task(task_id: int, current_user: CurrentUser = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    await versions.touch_tasks(db, current_user.id)
+    deleted = await delete_tasks(db, [task_id], current_user)
+    if not deleted:
         raise HTTPException(status_code=404, detail="Task not found")
-    db.delete(db_task)
-    db.commit()
+    await db.commit()
     return {"message": "Task deleted"}
 
 
+def check_bulk_size(items: list):
+    if len(items) > BULK_LIMIT:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_LIMIT} tasks per request")
+
+async def get_task(db: AsyncSession, task_id: int, current_user: CurrentUser) -> Task:
+    task = await db.scalar(select(Task).where(Task.id == task_id, Task.owner_id == current_user.id))
+    if task is None:
+        raise HTTPException(status_code=404, detail="Task not found")
+    return task
+
+async def delete_tasks(db: AsyncSession, task_ids: List[int], current_user: CurrentUser) -> List[int]:
+    """
+    Deletes the user's tasks along with their prompt results, in a few set-based statements
+    rather than loading every prompt through the ORM cascade. Returns the ids actually deleted.
+    """
+    owned = select(Task.id).where(Task.id.in_(task_ids), Task.owner_id == current_user.id)
+    prompt_ids = select(TaskPrompt.id).where(TaskPrompt.task_id.in_(owned))
+    # Credit history is kept, it just no longer points at a prompt result
+    await db.execute(
+        update(CreditTransaction).where(CreditTransaction.task_prompt_id.in_(prompt_ids)).values(task_prompt_id=None),
+        execution_options={"synchronize_session": False},
+    )
+    await db.execute(delete(TaskPrompt).where(TaskPrompt.task_id.in_(owned)), execution_options={"synchronize_session": False})
+    deleted = await db.scalars(
+        delete(Task).where(Task.id.in_(task_ids), Task.owner_id == current_user.id).returning(Task.id),
+        execution_options={"synchronize_session": False},
+    )
+    return deleted.all()
+
+def task_list_query(owner_id: int, sort: str, filter_name: str, q: str = ''):
+    """
+    The `GET /tasks` query, selecting the TaskResponse columns of each task followed by its sort key.
+    Sort by 'rank' when searching with `q` to get the best matches first.
+    """
+    if sort == 'rank':
+        sort_key = search_rank(q)
+    else:
+        sort_key = (SORT[sort] if sort in SORT else getattr(Task, sort)) if sort else Task.id
+    query = select(*responses.response_columns(TaskResponse, Task), sort_key.label('sort_key')).where(Task.owner_id == owner_id)
+    if q:
+        query = query.where(search_filter(q))
+    # id breaks ties so that every row has a well defined position for the cursor
+    query = query.order_by(sort_key, Task.id) if sort else query.order_by(Task.id)
+    return apply_filter(query, filter_name), sort_key
+
+async def task_stats(db: AsyncSession, owner_id: int) -> dict:
+    now, end_of_day, end_of_week = due_windows()
+    rows = await db.execute(TASK_STATS, {"owner_id": owner_id, "now": now, "end_of_day": end_of_day, "end_of_week": end_of_week})
+    stats = {"open": 0, "completed": 0, "overdue": 0, "today": 0, "week": 0, "high_priority": 0, "by_category": {}, "by_location": {}, "by_priority": {}}
+    for row in rows:
+        if row.is_category:
+            if row.category is not None and row.open:
+                stats["by_category"][row.category] = row.open
+        elif row.is_location:
+            if row.open:
+                # Tasks without a location are grouped under '', whether it is NULL or empty
+                location = row.location or ''
+                stats["by_location"][location] = stats["by_location"].get(location, 0) + row.open
+        elif row.is_priority:
+            if row.open:
+                stats["by_priority"][row.priority] = row.open
+        else:
+            stats.update(open=row.open, completed=row.completed, overdue=row.overdue, today=row.today, week=row.week, high_priority=row.high_priority)
+    return stats
+
+def due_windows():
+    """
+    Now, and the ends of the `today` and `week` filters.
+    """
+    now = datetime.now(timezone.utc)
+    end_of_day = now.replace(hour=23, minute=59, second=59, microsecond=0)
+    start_of_day = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    return now, end_of_day, start_of_day + timedelta(days=7)
+
+def search_filter(q: str):
+    """
+    Tasks with all the words of `q` (stemmed, in websearch syntax), or with words close enough to it
+    to allow for typos, once `set_search_similarity` has run. Both sides use the owner_id-led GIN
+    indexes on tasks.
+    """
+    return or_(
+        Task.search_vector.op('@@')(func.websearch_to_tsquery('english', q)),
+        Task.description.op('%>')(q),
+    )
+
+async def set_search_similarity(db: AsyncSession):
+    # pg_trgm's default of 0.6 misses common typos, like 'grocreies' (0.43 to 'groceries').
+    # Local to the transaction.
+    await db.execute(
+        text("SELECT set_config('pg_trgm.word_similarity_threshold', :threshold, true)"),
+        {"threshold": str(SEARCH_SIMILARITY)},
+    )
+
+def search_rank(q: str):
+    # Negated so the best match comes first in the ascending order the cursor expects
+    return -(func.ts_rank_cd(Task.search_vector, func.websearch_to_tsquery('english', q)) + func.word_similarity(q, Task.description))
+
 def apply_filter(query, filter_name):
     if filter_name == 'today':
-        now = datetime.now(timezone.utc)
-        end_of_day = now.replace(hour=23, minute=59, second=59, microsecond=0)
+        _, end_of_day, _ = due_windows()
 
         query = query.filter(Task.date_due != None)
         query = query.filter(Task.date_due <= end_of_day)
 
     elif filter_name == 'week':
-        now = datetime.now(timezone.utc)
-        start_of_day = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        end_of_week = start_of_day + timedelta(days=7)
+        _, _, end_of_week = due_windows()
 
         query = query.filter(Task.date_due != None)
         query = query.filter(Task.date_due <= end_of_week)
@@ -113,7 +502,8 @@ def apply_filter(query, filter_name):
 
     elif filter_name.startswith('category:'):
         category = filter_name[9:]
-        query = query.filter(Task.categories.any(category))
+        # @> rather than ANY so the GIN index on categories applies
+        query = query.filter(Task.categories.contains([category]))
 
     elif filter_name.startswith('location:'):
         location = filter_name[9:]
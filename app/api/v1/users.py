@@ -1,10 +1,12 @@
-from fastapi import APIRouter, HTTPException
-from typing import List
+from fastapi import APIRouter, HTTPException, Response
+from typing import List, Optional
 from fastapi.params import Depends
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
-from app.auth import get_password_hash, get_current_admin, generate_salt
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.auth import get_password_hash, get_current_admin, generate_salt, CurrentUser
 from app.database import get_db, User
+from app.lib import pagination, responses
 
 router = APIRouter()
 
@@ -25,28 +27,41 @@ class UserResponse(BaseModel):
 
 
 @router.get("/", response_model=List[UserResponse])
-async def read_users(skip: int = 0, limit: int = 100, current_user: User = Depends(get_current_admin), db: Session = Depends(get_db)):
-    users = db.query(User).order_by(User.id).offset(skip).limit(limit).all()
-    return users
+async def read_users(response: Response, skip: int = 0, limit: int = 100, cursor: Optional[str] = None, current_user: CurrentUser = Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
+    query = select(*responses.response_columns(UserResponse, User)).order_by(User.id)
+    if cursor:
+        try:
+            last_id = pagination.decode_cursor(cursor)['id']
+            if not pagination.is_cursor_value(last_id, int):
+                raise ValueError('Invalid cursor id')
+        except (ValueError, KeyError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = query.where(User.id > last_id)
+    else:
+        query = query.offset(skip)
+    rows = (await db.execute(query.limit(limit))).all()
+    if rows and len(rows) == limit:
+        response.headers['X-Next-Cursor'] = pagination.encode_cursor({'id': rows[-1].id})
+    return responses.rows_response(UserResponse, rows, response)
 
 @router.get("/{user_id}", response_model=UserResponse)
-async def read_user(user_id: int, current_user: User = Depends(get_current_admin), db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == user_id).first()
+async def read_user(user_id: int, current_user: CurrentUser = Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
+    user = await db.get(User, user_id)
     if user is None:
         raise HTTPException(status_code=404, detail="User not found")
     return user
 
 @router.post("/", response_model=UserResponse)
-async def create_user(user: UserCreate, db: Session = Depends(get_db)):
-    db_user = db.query(User).filter(User.email == user.email).first()
+async def create_user(user: UserCreate, db: AsyncSession = Depends(get_db)):
+    db_user = await db.scalar(select(User).where(User.email == user.email))
     if db_user:
         raise HTTPException(status_code=400, detail="Email already registered")
     if len(user.password) < 8:
         raise HTTPException(status_code=400, detail="Password must be at least 8 characters")
     salt = generate_salt()
-    hashed_password = get_password_hash(user.password, salt)
+    hashed_password = await get_password_hash(user.password, salt)
     db_user = User(email=user.email, hashed_password=hashed_password, salt=salt)
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     return db_user
\ No newline at end of file
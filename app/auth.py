@@ -1,27 +1,86 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
 from fastapi import HTTPException, status
 from fastapi.params import Depends
 from fastapi.security import OAuth2PasswordBearer
 import jwt
 import os
-from sqlalchemy.orm import Session
+import time
+from typing import Optional
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.database import get_db, User
+from app.lib.cache import TTLCache
 import bcrypt
 
 ALGORITHM = 'HS256'
 SECRET_KEY = os.getenv('SECRET_KEY')
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24
+AUTH_CACHE_TTL = float(os.getenv('AUTH_CACHE_TTL', 60))
+AUTH_CACHE_SIZE = int(os.getenv('AUTH_CACHE_SIZE', 10000))
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', 2))
+PASSWORD_HASH_QUEUE_LIMIT = int(os.getenv('PASSWORD_HASH_QUEUE_LIMIT', 32))
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
+
+# Decoded tokens (token -> user id) and the users they resolve to (user id -> CurrentUser). No route
+# changes or deletes users yet. One that does must pop the user from `_user_cache`, and other
+# workers catch up within AUTH_CACHE_TTL.
+_token_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+_user_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+
+# bcrypt is deliberately slow, so it runs on its own threads instead of the event loop
+_hash_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix='bcrypt')
+_hash_pending = 0
+
+
+@dataclass(frozen=True)
+class CurrentUser:
+    """
+    The authenticated user. Only holds the columns routes need, so it can be cached between requests.
+    """
+    id: int
+    email: str
+    name: str
+    is_admin: bool
+
 
 def generate_salt():
     return bcrypt.gensalt().decode('utf-8')
 
-def get_password_hash(password, salt):
-    return bcrypt.hashpw(password.encode('utf-8'), salt.encode('utf-8')).decode('utf-8')
+async def get_password_hash(password, salt):
+    hashed = await run_hash(bcrypt.hashpw, password.encode('utf-8'), salt.encode('utf-8'))
+    return hashed.decode('utf-8')
+
+async def verify_password(plain_password, hashed_password):
+    # The bcrypt hash embeds its salt, so checkpw doesn't need the stored one
+    return await run_hash(bcrypt.checkpw, plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
+
+async def run_hash(fn, *args):
+    """
+    Runs `fn` on the bcrypt pool. Sheds load with a 503 once PASSWORD_HASH_QUEUE_LIMIT hashes
+    are already running or waiting, rather than letting a login burst queue up indefinitely.
+    """
+    global _hash_pending
+    if _hash_pending >= PASSWORD_HASH_QUEUE_LIMIT:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many login attempts in progress, try again shortly",
+            headers={"Retry-After": "1"},
+        )
+    _hash_pending += 1
+    loop = asyncio.get_running_loop()
+    job = _hash_executor.submit(fn, *args)
+    # Counted until the hash is done rather than until the caller stops waiting, as the thread
+    # carries on if the request is cancelled. The callback may run on a pool thread.
+    job.add_done_callback(lambda _: loop.call_soon_threadsafe(_hash_done))
+    return await asyncio.wrap_future(job)
 
-def verify_password(plain_password, hashed_password, salt):
-    return hashed_password == get_password_hash(plain_password, salt)
+def _hash_done():
+    global _hash_pending
+    _hash_pending -= 1
 
 def create_access_token(data: dict):
     to_encode = data.copy()
@@ -29,25 +88,49 @@ def create_access_token(data: dict):
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)) -> CurrentUser:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: str = payload.get("sub")
-        if user_id is None:
+    user_id = _token_cache.get(token)
+    if user_id is None:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            sub: str = payload.get("sub")
+            if sub is None:
+                raise credentials_exception
+        except jwt.PyJWTError:
+            raise credentials_exception
+        user_id = int(sub)
+        # Never trust a cached token past its expiry
+        _token_cache.set(token, user_id, ttl=min(AUTH_CACHE_TTL, payload["exp"] - time.time()))
+
+    current_user = _user_cache.get(user_id)
+    if current_user is None:
+        user = await db.get(User, user_id)
+        if user is None:
             raise credentials_exception
-    except jwt.PyJWTError:
-        raise credentials_exception
-    user = db.query(User).filter(User.id == int(user_id)).first()
-    if user is None:
-        raise credentials_exception
-    return user
-
-def get_current_admin(current_user: User = Depends(get_current_user)):
+        current_user = CurrentUser(id=user.id, email=user.email, name=user.name, is_admin=user.is_admin)
+        _user_cache.set(user_id, current_user)
+    return current_user
+
+async def get_streaming_user(access_token: Optional[str] = None, token: Optional[str] = Depends(optional_oauth2_scheme), db: AsyncSession = Depends(get_db)) -> CurrentUser:
+    """
+    Like get_current_user, but also accepts the token as an `access_token` query parameter, for
+    clients like EventSource that can't set headers.
+    """
+    token = token or access_token
+    if not token:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not authenticated",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return await get_current_user(token, db)
+
+def get_current_admin(current_user: CurrentUser = Depends(get_current_user)):
     if not current_user.is_admin:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
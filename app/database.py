@@ -1,13 +1,40 @@
 import os
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime, text, ForeignKey
-from sqlalchemy.dialects.postgresql import ARRAY
+from datetime import timezone
+from sqlalchemy import Column, BigInteger, Integer, String, Boolean, DateTime, Float, text, Computed, ForeignKey, Index, make_url, TypeDecorator
+from sqlalchemy.dialects.postgresql import ARRAY, TSVECTOR
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import deferred, relationship
+from app.lib import metrics
 
-engine = create_engine(os.getenv('SQLALCHEMY_DATABASE_URL'))
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+def async_database_url(url: str):
+    # SQLALCHEMY_DATABASE_URL is shared with alembic, which stays on psycopg2
+    return make_url(url).set(drivername='postgresql+asyncpg')
+
+engine = create_async_engine(async_database_url(os.getenv('SQLALCHEMY_DATABASE_URL')))
+metrics.instrument_engine(engine.sync_engine)
+# Attributes can't be lazy loaded under asyncio, so don't expire them on commit
+SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
+
+class UTCDateTime(TypeDecorator):
+    """
+    A timezone-naive UTC timestamp. asyncpg refuses aware datetimes for `timestamp` columns,
+    so they are converted to UTC first.
+    """
+    impl = DateTime
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return naive_utc(value)
+
+def naive_utc(value):
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
 # Models
 
 class User(Base):
@@ -18,6 +45,8 @@ class User(Base):
     hashed_password = Column(String)
     salt = Column(String)
     is_admin = Column(Boolean, default=False)
+    credit_balance = Column(Integer, nullable=False, default=0, server_default=text("0"))  # Sum of credit_transactions, see app.lib.credits
+    task_version = Column(BigInteger, nullable=False, default=0, server_default=text("0"))  # Bumped on every change to the user's tasks, see app.lib.versions
 
     # One-to-many relationship: one user can have many tasks
     tasks = relationship("Task", back_populates="owner", cascade="all, delete-orphan")
@@ -29,24 +58,43 @@ class Task(Base):
     description = Column(String)
     location = Column(String)
     priority = Column(Integer, nullable=False, default=0)
-    date_added = Column(DateTime, nullable=False, server_default=text("NOW()"))
-    date_due = Column(DateTime, nullable=True)
-    date_completed = Column(DateTime, nullable=True)
+    date_added = Column(UTCDateTime, nullable=False, server_default=text("NOW()"))
+    date_due = Column(UTCDateTime, nullable=True)
+    date_completed = Column(UTCDateTime, nullable=True)
     status = Column(String)
     categories = Column(ARRAY(String))
     owner_id = Column(Integer, ForeignKey('users.id'))
+    version = Column(BigInteger, nullable=False, server_default=text("nextval('change_version_seq')"))  # Bumped by a trigger on every change, see GET /tasks/changes
+    search_vector = deferred(Column(TSVECTOR, Computed("to_tsvector('english', coalesce(description, ''))", persisted=True)))  # Only used in queries
 
     owner = relationship("User", back_populates="tasks")
     prompts = relationship("TaskPrompt", back_populates="task", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        # Task lists only show open tasks unless filtering on completed ones, with one index per sort
+        Index('ix_tasks_owner_id_open', 'owner_id', 'id', postgresql_where=text('date_completed IS NULL')),
+        Index('ix_tasks_owner_id_date_due_open', 'owner_id', 'date_due', 'id', postgresql_where=text('date_completed IS NULL')),
+        Index('ix_tasks_owner_id_date_added_open', 'owner_id', 'date_added', 'id', postgresql_where=text('date_completed IS NULL')),
+        Index('ix_tasks_owner_id_priority_open', 'owner_id', text('(CASE WHEN priority = 0 THEN 7 ELSE priority END)'), 'id', postgresql_where=text('date_completed IS NULL')),
+        Index('ix_tasks_owner_id_location_open', 'owner_id', 'location', postgresql_where=text('date_completed IS NULL')),
+        Index('ix_tasks_owner_id_date_completed', 'owner_id', 'date_completed', 'id', postgresql_where=text('date_completed IS NOT NULL')),
+        Index('ix_tasks_categories', 'categories', postgresql_using='gin'),
+        Index('ix_tasks_owner_id_version', 'owner_id', 'version'),
+        # Search, see tasks.search_filter. Both need btree_gin for owner_id, the second pg_trgm
+        Index('ix_tasks_owner_id_search_vector', 'owner_id', 'search_vector', postgresql_using='gin'),
+        Index('ix_tasks_owner_id_description_trgm', 'owner_id', 'description', postgresql_using='gin', postgresql_ops={'description': 'gin_trgm_ops'}),
+    )
+
 class AIPrompt(Base):
     __tablename__ = 'ai_prompts'
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String)
     description = Column(String)
     cost = Column(Integer)
-    prompt_template = Column(String)
+    prompt_template = Column(String)  # The user message, see app.lib.templates for the variables
+    instructions = Column(String, nullable=True)  # Static system prompt, cached upstream across calls
     returns_json = Column(Boolean, default=False)
+    cacheable = Column(Boolean, nullable=False, default=True, server_default=text("true"))  # Whether results may be reused across tasks
 
     task_prompts = relationship("TaskPrompt", back_populates="ai_prompt", cascade="all, delete-orphan")
 
@@ -57,11 +105,16 @@ class TaskPrompt(Base):
     ai_prompt_id = Column(Integer, ForeignKey('ai_prompts.id'))
     date_added = Column(DateTime, nullable=False, server_default=text("NOW()"))
     result = Column(String)
+    version = Column(BigInteger, nullable=False, server_default=text("nextval('change_version_seq')"))  # Bumped by a trigger on every change
 
     task = relationship("Task", back_populates="prompts")
     ai_prompt = relationship("AIPrompt", back_populates="task_prompts")
     credit_transaction = relationship("CreditTransaction", back_populates="task_prompt", uselist=False)
 
+    __table_args__ = (
+        Index('ix_task_prompts_task_id', 'task_id', 'id'),
+    )
+
 class CreditTransaction(Base):
     __tablename__ = 'credit_transactions'
     id = Column(Integer, primary_key=True, index=True)
@@ -74,13 +127,70 @@ class CreditTransaction(Base):
     user = relationship("User", back_populates="credit_transactions")
     task_prompt = relationship("TaskPrompt", back_populates="credit_transaction")
 
+    __table_args__ = (
+        Index('ix_credit_transactions_user_id', 'user_id', 'id'),
+        Index('ix_credit_transactions_task_prompt_id', 'task_prompt_id'),
+    )
+
+class PromptJob(Base):
+    __tablename__ = 'prompt_jobs'
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    task_id = Column(Integer, ForeignKey('tasks.id', ondelete='CASCADE'), nullable=False)
+    ai_prompt_id = Column(Integer, ForeignKey('ai_prompts.id'), nullable=False)
+    status = Column(String, nullable=False, default='queued')  # queued, running, succeeded, failed
+    attempts = Column(Integer, nullable=False, default=0)
+    error = Column(String, nullable=True)
+    task_prompt_id = Column(Integer, ForeignKey('task_prompts.id', ondelete='SET NULL'), nullable=True)
+    credit_transaction_id = Column(Integer, ForeignKey('credit_transactions.id', ondelete='SET NULL'), nullable=True)  # Credits reserved for the job
+    date_added = Column(DateTime, nullable=False, server_default=text("NOW()"))
+    date_started = Column(DateTime, nullable=True)
+    date_completed = Column(DateTime, nullable=True)
+
+    task_prompt = relationship("TaskPrompt")
+    credit_transaction = relationship("CreditTransaction")
+
+    __table_args__ = (
+        # Only unfinished jobs are ever claimed, so keep the index small
+        Index('ix_prompt_jobs_pending', 'id', postgresql_where=text("status IN ('queued', 'running')")),
+        # Foreign keys that deletes of tasks, prompt results and credit reservations have to check
+        Index('ix_prompt_jobs_task_id', 'task_id'),
+        Index('ix_prompt_jobs_task_prompt_id', 'task_prompt_id'),
+        Index('ix_prompt_jobs_credit_transaction_id', 'credit_transaction_id'),
+    )
+
+class LLMCacheEntry(Base):
+    __tablename__ = 'llm_cache'
+    key = Column(String, primary_key=True)  # sha256 of model, max_tokens and prompt
+    result = Column(String, nullable=False)
+    date_added = Column(DateTime, nullable=False, server_default=text("NOW()"))
+
+class RateLimitBucket(Base):
+    __tablename__ = 'rate_limit_buckets'
+    key = Column(String, primary_key=True)  # See app.lib.ratelimit
+    tokens = Column(Float, nullable=False)
+    refilled_at = Column(Float, nullable=False)  # Epoch seconds, by the database clock
+
+class TaskTombstone(Base):
+    __tablename__ = 'task_tombstones'
+    task_id = Column(Integer, primary_key=True)  # Written by a trigger when the task is deleted
+    owner_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    version = Column(BigInteger, nullable=False, server_default=text("nextval('change_version_seq')"))
+    date_deleted = Column(DateTime, nullable=False, server_default=text("NOW()"))
+
+    __table_args__ = (
+        Index('ix_task_tombstones_owner_id_version', 'owner_id', 'version'),
+    )
+
+class CatalogVersion(Base):
+    __tablename__ = 'catalog_versions'
+    name = Column(String, primary_key=True)  # Table name, bumped by a trigger on every write to it
+    version = Column(BigInteger, nullable=False, default=0, server_default=text("0"))
+
 
 # Create tables
 # Base.metadata.create_all(bind=engine)
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
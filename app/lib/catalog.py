@@ -0,0 +1,99 @@
+"""
+The AI prompt catalog, loaded once per process into an immutable map with each template already
+compiled. A trigger on ai_prompts bumps its row in catalog_versions and notifies on every write
+(see `notify`), and the map is swapped for a fresh one when that version moves.
+"""
+import asyncio
+import os
+import time
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Mapping, Optional
+from sqlalchemy import select
+from app.database import SessionLocal, AIPrompt
+from app.lib import notify, versions
+from app.lib.templates import Template
+
+CATALOG_MAX_AGE = float(os.getenv('CATALOG_MAX_AGE', 300))  # Reload at least this often, in case a notification is lost
+CHANNEL = 'catalog_versions'
+
+
+@dataclass(frozen=True)
+class Prompt:
+    id: int
+    name: str
+    description: str
+    cost: int
+    returns_json: bool
+    cacheable: bool
+    instructions: Optional[str]
+    template: Template
+
+@dataclass(frozen=True)
+class Catalog:
+    version: int
+    prompts: Mapping[int, Prompt]  # In id order
+    loaded_at: float
+
+
+_catalog: Optional[Catalog] = None
+_lock = asyncio.Lock()
+_refreshes = set()
+
+
+async def get() -> Catalog:
+    if _catalog is None or time.monotonic() - _catalog.loaded_at > CATALOG_MAX_AGE:
+        await refresh(max_age=CATALOG_MAX_AGE)
+    return _catalog
+
+async def get_prompt(prompt_id: int) -> Optional[Prompt]:
+    return (await get()).prompts.get(prompt_id)
+
+async def refresh(min_version: int = None, max_age: float = None):
+    """
+    Reloads the catalog, unless whoever held the lock before us already loaded `min_version`
+    or something younger than `max_age`.
+    """
+    global _catalog
+    async with _lock:
+        if _catalog is not None:
+            if min_version is not None and _catalog.version >= min_version:
+                return
+            if max_age is not None and time.monotonic() - _catalog.loaded_at <= max_age:
+                return
+        async with SessionLocal() as db:
+            # Version first: if a write lands in between, the newer rows get reloaded anyway
+            version = await versions.catalog_version(db)
+            rows = (await db.scalars(select(AIPrompt).order_by(AIPrompt.id))).all()
+        _catalog = Catalog(version, MappingProxyType({row.id: _to_prompt(row) for row in rows}), time.monotonic())
+
+def watch():
+    """
+    Refreshes the catalog whenever it changes. Needs `notify.listen` running.
+    """
+    notify.subscribe(CHANNEL, _on_notify)
+
+
+def _on_notify(payload: Optional[str]):
+    # Payloads are "<table>:<version>"; None means notifications may have been missed
+    min_version = None
+    if payload is not None:
+        name, version = payload.split(':')
+        if name != 'ai_prompts':
+            return
+        min_version = int(version)
+    task = asyncio.get_running_loop().create_task(refresh(min_version))
+    _refreshes.add(task)
+    task.add_done_callback(_refreshes.discard)
+
+def _to_prompt(row: AIPrompt) -> Prompt:
+    return Prompt(
+        id=row.id,
+        name=row.name,
+        description=row.description,
+        cost=row.cost,
+        returns_json=row.returns_json,
+        cacheable=row.cacheable,
+        instructions=row.instructions,
+        template=Template(row.prompt_template),
+    )
@@ -0,0 +1,56 @@
+"""
+users.credit_balance always equals the sum of the user's credit_transactions. Every ledger insert
+or delete goes through the helpers below, which update the balance in the same transaction.
+None of them commit, that is up to the caller.
+"""
+from typing import Optional, Tuple
+from sqlalchemy import select, text, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database import User, CreditTransaction
+
+
+async def get_balance(db: AsyncSession, user_id: int) -> int:
+    return (await db.execute(select(User.credit_balance).where(User.id == user_id))).scalar_one()
+
+async def reserve(db: AsyncSession, user_id: int, amount: int) -> Optional[Tuple[CreditTransaction, int]]:
+    """
+    Deducts `amount` if the user can afford it, recording it as a usage transaction without a
+    task prompt yet. Returns the transaction and the new balance, or None if the balance is too low.
+    """
+    balance = (await db.execute(
+        update(User)
+        .where(User.id == user_id, User.credit_balance >= amount)
+        .values(credit_balance=User.credit_balance - amount)
+        .returning(User.credit_balance)
+    )).scalar_one_or_none()
+    if balance is None:
+        return None
+    transaction = CreditTransaction(user_id=user_id, amount=-amount)
+    db.add(transaction)
+    await db.flush()
+    return transaction, balance
+
+async def release(db: AsyncSession, transaction: CreditTransaction):
+    """
+    Reverses a reservation whose prompt never produced a result.
+    """
+    await db.execute(
+        update(User).where(User.id == transaction.user_id).values(credit_balance=User.credit_balance - transaction.amount)
+    )
+    await db.delete(transaction)
+    await db.flush()
+
+async def reconcile(db: AsyncSession) -> int:
+    """
+    Rebuilds every balance from the ledger, returning how many users were corrected.
+    """
+    # Lock the users first so no reservation can slip in between summing and updating
+    await db.execute(text("SELECT id FROM users ORDER BY id FOR UPDATE"))
+    corrected = (await db.execute(text("""
+        UPDATE users SET credit_balance = COALESCE(ledger.total, 0)
+        FROM users u
+        LEFT JOIN (SELECT user_id, SUM(amount) AS total FROM credit_transactions GROUP BY user_id) ledger ON ledger.user_id = u.id
+        WHERE users.id = u.id AND users.credit_balance <> COALESCE(ledger.total, 0)
+        RETURNING users.id
+    """))).all()
+    return len(corrected)
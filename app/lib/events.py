@@ -0,0 +1,60 @@
+"""
+Per-user change events for GET /events. Every bump of a user's task version (see
+`versions.touch_tasks`) is notified by a trigger on users, whichever process made it, and fanned
+out here to that user's open streams. Events only carry the new version; clients fetch what
+changed with GET /tasks/changes.
+"""
+import asyncio
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Optional
+from app.lib import notify
+
+CHANNEL = 'task_events'
+
+
+@dataclass(eq=False)
+class Subscription:
+    user_id: int
+    version: Optional[int] = None  # Latest notified, None if notifications may have been missed
+    changed: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+_subscriptions = defaultdict(set)  # user id -> {Subscription}
+
+
+def watch():
+    """
+    Delivers task events to subscriptions. Needs `notify.listen` running.
+    """
+    notify.subscribe(CHANNEL, _on_notify)
+
+def subscribe(user_id: int) -> Subscription:
+    subscription = Subscription(user_id)
+    _subscriptions[user_id].add(subscription)
+    return subscription
+
+def unsubscribe(subscription: Subscription):
+    subscriptions = _subscriptions.get(subscription.user_id)
+    if subscriptions is not None:
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            del _subscriptions[subscription.user_id]
+
+
+def _on_notify(payload: Optional[str]):
+    # Payloads are "<user id>:<task version>"; None means notifications may have been missed
+    if payload is None:
+        for subscriptions in _subscriptions.values():
+            for subscription in subscriptions:
+                _deliver(subscription, None)
+        return
+    user_id, version = payload.split(':')
+    for subscription in _subscriptions.get(int(user_id), ()):
+        _deliver(subscription, int(version))
+
+def _deliver(subscription: Subscription, version: Optional[int]):
+    # Only the latest version matters, so a slow client just skips the ones in between
+    if version is None or subscription.version is None or version > subscription.version:
+        subscription.version = version
+    subscription.changed.set()
@@ -1,21 +1,327 @@
-from anthropic import Anthropic
+from anthropic import Anthropic, AsyncAnthropic, APIConnectionError, APIStatusError
+import asyncio
+import hashlib
+import json
 import os
+import time
+from contextlib import AsyncExitStack, asynccontextmanager
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert
+from app.database import SessionLocal, LLMCacheEntry
+from app.lib import metrics, resilience
+from app.lib.cache import TTLCache
 
-client = Anthropic(api_key=os.getenv('ANTHROPIC_API_KEY'))
+DEFAULT_MODEL = 'claude-3-sonnet-20240229'
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', 60))
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', 16))
+LLM_MAX_QUEUE = int(os.getenv('LLM_MAX_QUEUE', 64))
+LLM_QUEUE_TIMEOUT = float(os.getenv('LLM_QUEUE_TIMEOUT', 10))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', 2))
+LLM_RETRY_BASE_DELAY = float(os.getenv('LLM_RETRY_BASE_DELAY', 0.5))
+LLM_RETRY_MAX_DELAY = float(os.getenv('LLM_RETRY_MAX_DELAY', 8))
+LLM_HEDGE = os.getenv('LLM_HEDGE', 'false').lower() == 'true'
+LLM_BREAKER_FAILURES = int(os.getenv('LLM_BREAKER_FAILURES', 5))
+LLM_BREAKER_COOLDOWN = float(os.getenv('LLM_BREAKER_COOLDOWN', 30))
+LLM_CACHE_SIZE = int(os.getenv('LLM_CACHE_SIZE', 1000))
+LLM_CACHE_TTL = float(os.getenv('LLM_CACHE_TTL', 60 * 60))
+LLM_CACHE_DB = os.getenv('LLM_CACHE_DB', 'false').lower() == 'true'
+LLM_CACHE_DB_TTL = float(os.getenv('LLM_CACHE_DB_TTL', 60 * 60 * 24 * 7))
 
-def invoke(prompt: str, model='claude-3-sonnet-20240229', max_tokens=1000) -> str:
-    message = client.messages.create(
-        model=model,
-        max_tokens=max_tokens,
-        messages=[{
+client = Anthropic(api_key=os.getenv('ANTHROPIC_API_KEY'), timeout=LLM_TIMEOUT, max_retries=LLM_MAX_RETRIES)
+
+# One async client per worker so every call shares the same connection pool. It doesn't retry
+# by itself, `policy` does.
+async_client = AsyncAnthropic(api_key=os.getenv('ANTHROPIC_API_KEY'), timeout=LLM_TIMEOUT, max_retries=0)
+_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+_waiting = 0
+
+# Results of identical prompts are shared: in memory per worker, and optionally in Postgres across workers
+_cache = TTLCache(LLM_CACHE_SIZE, LLM_CACHE_TTL)
+_in_flight = {}
+
+
+def retryable(e: BaseException) -> bool:
+    """
+    Failures the upstream may recover from: timeouts, dropped connections, rate limits and
+    server errors, including 529 overloaded.
+    """
+    if isinstance(e, APIStatusError):
+        return e.status_code in (408, 409, 429) or e.status_code >= 500
+    return isinstance(e, (APIConnectionError, asyncio.TimeoutError))
+
+def retry_after(e: BaseException):
+    if isinstance(e, APIStatusError):
+        try:
+            return float(e.response.headers.get('retry-after', ''))
+        except ValueError:
+            return None
+    return None
+
+# Shared by every async call in the worker, so the breaker sees all of them
+policy = resilience.Policy(
+    retries=LLM_MAX_RETRIES,
+    base_delay=LLM_RETRY_BASE_DELAY,
+    max_delay=LLM_RETRY_MAX_DELAY,
+    retryable=retryable,
+    retry_after=retry_after,
+    breaker=resilience.CircuitBreaker(LLM_BREAKER_FAILURES, LLM_BREAKER_COOLDOWN),
+    hedge=LLM_HEDGE,
+    on_event=lambda event: metrics.LLM_POLICY_EVENTS.labels(event).inc(),
+)
+
+
+class LLMOverloaded(Exception):
+    """
+    Raised instead of waiting when LLM_MAX_QUEUE calls are already waiting for a slot, or after
+    waiting `queue_timeout` without getting one.
+    """
+    pass
+
+
+def invoke(prompt: str, model=DEFAULT_MODEL, max_tokens=1000) -> str:
+    start = time.perf_counter()
+    try:
+        message = client.messages.create(
+            model=model,
+            max_tokens=max_tokens,
+            messages=[{
+                "role": "user",
+                "content": prompt,
+            }]
+        )
+    except BaseException:
+        metrics.observe_llm(start, 'error')
+        raise
+    metrics.observe_llm(start, 'success', message.usage)
+    response = message.content[0].text
+    return clean_response(response)
+
+async def ainvoke(prompt: str, model=DEFAULT_MODEL, max_tokens=1000, timeout: float = None, cache: bool = True, system: str = None, queue_timeout: float = None) -> str:
+    """
+    Async version of `invoke`. At most LLM_MAX_CONCURRENCY calls are in flight per worker,
+    the rest wait their turn without blocking the event loop. With a `queue_timeout`, the call
+    raises LLMOverloaded rather than joining a full queue or waiting longer than that for a turn;
+    without one it waits as long as it takes, which suits background jobs.
+
+    `system` is sent as a system prompt marked for upstream prompt caching, so keep anything
+    that varies between calls in `prompt`.
+
+    With `cache`, results are reused for identical prompts and concurrent identical calls
+    share a single upstream request.
+
+    Calls go through `policy`: failures worth retrying are retried until `timeout` (LLM_TIMEOUT by
+    default) runs out, and resilience.CircuitOpen is raised straight away while the upstream is
+    failing. With LLM_HEDGE, a call slower than most gets a second request alongside.
+    """
+    if not cache:
+        return await _create(prompt, model, max_tokens, timeout, system, queue_timeout)
+
+    key = cache_key(prompt, model, max_tokens, system)
+    result = _cache.get(key)
+    if result is not None:
+        metrics.LLM_CACHE_LOOKUPS.labels('hit').inc()
+        return result
+
+    request = _in_flight.get(key)
+    if request is None:
+        # Run the upstream call as its own task so it completes for the other callers
+        # even if the caller that started it goes away
+        request = asyncio.ensure_future(_fetch(key, prompt, model, max_tokens, timeout, system, queue_timeout))
+        _in_flight[key] = request
+        request.add_done_callback(lambda done: _request_done(key, done))
+    else:
+        metrics.LLM_CACHE_LOOKUPS.labels('coalesced').inc()
+    return await asyncio.shield(request)
+
+async def get_cached(prompt: str, model=DEFAULT_MODEL, max_tokens=1000, system: str = None):
+    key = cache_key(prompt, model, max_tokens, system)
+    result = _cache.get(key)
+    if result is None and LLM_CACHE_DB:
+        result = await _db_cache_get(key)
+        if result is not None:
+            _cache.set(key, result)
+    metrics.LLM_CACHE_LOOKUPS.labels('hit' if result is not None else 'miss').inc()
+    return result
+
+async def set_cached(prompt: str, result: str, model=DEFAULT_MODEL, max_tokens=1000, system: str = None):
+    key = cache_key(prompt, model, max_tokens, system)
+    _cache.set(key, result)
+    if LLM_CACHE_DB:
+        await _db_cache_set(key, result)
+
+def cache_key(prompt: str, model: str, max_tokens: int, system: str = None) -> str:
+    # Without a system prompt, keys are the same as before it was added
+    parts = [model, max_tokens, prompt] if system is None else [model, max_tokens, prompt, system]
+    return hashlib.sha256(json.dumps(parts).encode('utf-8')).hexdigest()
+
+def outcome(e: BaseException) -> str:
+    # The `outcome` label of failed calls
+    return 'circuit_open' if isinstance(e, resilience.CircuitOpen) else 'error'
+
+def overloaded() -> bool:
+    """
+    Whether a call with a `queue_timeout` would be turned away right now.
+    """
+    return _semaphore.locked() and _waiting >= LLM_MAX_QUEUE
+
+def system_blocks(system: str) -> list:
+    """
+    The system prompt as a single block with a cache breakpoint, so the upstream can reuse its
+    processed prefix across calls. Prefixes shorter than the model's minimum are not cached.
+    """
+    return [{"type": "text", "text": system, "cache_control": {"type": "ephemeral"}}]
+
+def _request_args(prompt: str, model: str, max_tokens: int, timeout: float, system: str) -> dict:
+    args = {
+        "model": model,
+        "max_tokens": max_tokens,
+        "messages": [{
             "role": "user",
             "content": prompt,
-        }]
-    )
+        }],
+        "timeout": timeout or LLM_TIMEOUT,
+    }
+    if system:
+        args["system"] = system_blocks(system)
+    return args
+
+@asynccontextmanager
+async def _slot(queue_timeout: float = None):
+    global _waiting
+    if queue_timeout is not None and overloaded():
+        raise LLMOverloaded()
+    _waiting += 1
+    try:
+        if queue_timeout is None:
+            await _semaphore.acquire()
+        else:
+            try:
+                await asyncio.wait_for(_semaphore.acquire(), queue_timeout)
+            except asyncio.TimeoutError:
+                raise LLMOverloaded()
+    finally:
+        _waiting -= 1
+    try:
+        yield
+    finally:
+        _semaphore.release()
+
+async def _create(prompt: str, model: str, max_tokens: int, timeout: float, system: str = None, queue_timeout: float = None) -> str:
+    async with _slot(queue_timeout):
+        # Timed from here so waiting for the semaphore doesn't count as LLM latency
+        start = time.perf_counter()
+        try:
+            message = await policy.run(
+                lambda left: async_client.messages.create(**_request_args(prompt, model, max_tokens, left, system)),
+                timeout or LLM_TIMEOUT,
+            )
+        except BaseException as e:
+            metrics.observe_llm(start, outcome(e))
+            raise
+    metrics.observe_llm(start, 'success', message.usage)
     response = message.content[0].text
     return clean_response(response)
 
+async def _fetch(key: str, prompt: str, model: str, max_tokens: int, timeout: float, system: str, queue_timeout: float) -> str:
+    result = await _db_cache_get(key) if LLM_CACHE_DB else None
+    if result is None:
+        metrics.LLM_CACHE_LOOKUPS.labels('miss').inc()
+        result = await _create(prompt, model, max_tokens, timeout, system, queue_timeout)
+        if LLM_CACHE_DB:
+            await _db_cache_set(key, result)
+    else:
+        metrics.LLM_CACHE_LOOKUPS.labels('hit').inc()
+    _cache.set(key, result)
+    return result
+
+def _request_done(key: str, request: asyncio.Future):
+    if _in_flight.get(key) is request:
+        del _in_flight[key]
+    # Mark the exception as retrieved in case every caller has gone away
+    if not request.cancelled():
+        request.exception()
+
+async def _db_cache_get(key: str):
+    async with SessionLocal() as db:
+        return await db.scalar(select(LLMCacheEntry.result).where(
+            LLMCacheEntry.key == key,
+            LLMCacheEntry.date_added > func.now() - func.make_interval(0, 0, 0, 0, 0, 0, LLM_CACHE_DB_TTL),
+        ))
+
+async def _db_cache_set(key: str, result: str):
+    async with SessionLocal() as db:
+        await db.execute(insert(LLMCacheEntry).values(key=key, result=result).on_conflict_do_update(
+            index_elements=[LLMCacheEntry.key],
+            set_={"result": result, "date_added": func.now()},
+        ))
+        await db.commit()
+
+
+async def astream(prompt: str, model=DEFAULT_MODEL, max_tokens=1000, timeout: float = None, system: str = None, queue_timeout: float = None):
+    """
+    Yields the raw response text as it is generated. Use `ResponseCleaner` to clean it on the fly.
+    `queue_timeout` is as for `ainvoke`. Opening the stream goes through `policy`, without hedging;
+    once text has been yielded a failure can't be retried.
+    """
+    async with _slot(queue_timeout):
+        start = time.perf_counter()
+        try:
+            async with AsyncExitStack() as stack:
+                stream = await policy.run(
+                    lambda left: stack.enter_async_context(async_client.messages.stream(**_request_args(prompt, model, max_tokens, left, system))),
+                    timeout or LLM_TIMEOUT,
+                    hedge=False,
+                )
+                async for text in stream.text_stream:
+                    yield text
+                message = await stream.get_final_message()
+        except BaseException as e:
+            metrics.observe_llm(start, outcome(e))
+            raise
+    metrics.observe_llm(start, 'success', message.usage)
+
+MARKDOWN_FENCE = '```markdown\n'
+
 def clean_response(response: str) -> str:
-    if response.startswith('```markdown\n') and response.endswith('```'):
+    if response.startswith(MARKDOWN_FENCE) and response.endswith('```'):
         response = response[12:-3].strip()
-    return response
\ No newline at end of file
+    return response
+
+class ResponseCleaner:
+    """
+    Incremental version of `clean_response` for streamed text. Text that might still turn out to be
+    the opening or closing fence is held back until more text arrives or `finish` is called.
+    The opening fence is dropped as soon as it is seen, so unlike `clean_response` a response cut
+    off before its closing fence comes out without it. Save the cleaned text, not the raw response.
+    """
+    def __init__(self):
+        self.buffer = ''
+        self.fenced = None
+        self.started = False
+
+    def feed(self, text: str) -> str:
+        self.buffer += text
+        if self.fenced is None:
+            if self.buffer.startswith(MARKDOWN_FENCE):
+                self.fenced = True
+                self.buffer = self.buffer[len(MARKDOWN_FENCE):]
+            elif MARKDOWN_FENCE.startswith(self.buffer):
+                return ''
+            else:
+                self.fenced = False
+        if not self.fenced:
+            output, self.buffer = self.buffer, ''
+            return output
+        if not self.started:
+            self.buffer = self.buffer.lstrip()
+            self.started = bool(self.buffer)
+        # Keep a possible closing fence, and the whitespace before it, in the buffer
+        cut = len(self.buffer.rstrip('`').rstrip())
+        output, self.buffer = self.buffer[:cut], self.buffer[cut:]
+        return output
+
+    def finish(self) -> str:
+        output, self.buffer = self.buffer, ''
+        if self.fenced and output.endswith('```'):
+            output = output[:-3].rstrip()
+        return output
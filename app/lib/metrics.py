@@ -0,0 +1,160 @@
+"""
+Prometheus metrics, served at /metrics, and optional Server-Timing headers. Per-request numbers
+(DB time and query count, pool checkout wait, LLM time) are gathered in a RequestStats kept in a
+context variable for the duration of each request.
+
+Set PROMETHEUS_MULTIPROC_DIR when running several worker processes so /metrics covers all of them.
+"""
+import contextvars
+import os
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+from sqlalchemy import event
+from app.lib import profiling
+
+SERVER_TIMING = os.getenv('SERVER_TIMING', 'false').lower() == 'true'
+
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'Time to the end of the response', ['method', 'route', 'status'])
+REQUEST_DB_TIME = Histogram('http_request_db_seconds', 'Time spent in database queries per request', ['route'])
+REQUEST_DB_QUERIES = Histogram('http_request_db_queries', 'Database queries per request', ['route'], buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50, 100))
+POOL_CHECKOUT_WAIT = Histogram('db_pool_checkout_seconds', 'Time waiting for a pooled database connection', buckets=(.0005, .001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+LLM_LATENCY = Histogram('llm_request_duration_seconds', 'LLM request time', ['prompt', 'outcome'], buckets=(.25, .5, 1, 2.5, 5, 10, 20, 30, 60, 120))
+LLM_POLICY_EVENTS = Counter('llm_policy_events', 'LLM retries, hedged requests and calls failed fast by the circuit breaker', ['event'])
+LLM_CACHE_LOOKUPS = Counter('llm_cache_lookups', 'LLM result cache lookups: hit, miss, or coalesced into a request already in flight', ['result'])
+LLM_TOKENS = Counter('llm_tokens', 'LLM tokens used', ['prompt', 'type'])
+CREDIT_REJECTIONS = Counter('credit_rejections', 'Prompt runs refused for insufficient credits', ['endpoint'])
+LLM_REJECTIONS = Counter('llm_rejections', 'Prompt runs refused by a rate limit or a full LLM queue', ['endpoint', 'reason'])
+
+# Which AIPrompt the LLM calls in this context are for, used as the `prompt` label
+current_prompt: contextvars.ContextVar[str] = contextvars.ContextVar('current_prompt', default='unknown')
+
+
+@dataclass
+class RequestStats:
+    start: float
+    db_time: float = 0
+    queries: int = 0
+    pool_wait: float = 0
+    llm_time: float = 0
+    statements: Optional[List[str]] = None  # Only with QUERY_PROFILING
+
+    def server_timing(self) -> str:
+        return ', '.join([
+            f'db;dur={self.db_time * 1000:.1f};desc="{self.queries} queries"',
+            f'pool;dur={self.pool_wait * 1000:.1f}',
+            f'llm;dur={self.llm_time * 1000:.1f}',
+            f'total;dur={(time.perf_counter() - self.start) * 1000:.1f}',
+        ])
+
+_request_stats: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar('request_stats', default=None)
+
+
+class MetricsMiddleware:
+    """
+    Records the latency and DB usage of every request under its route template, and adds a
+    Server-Timing header if SERVER_TIMING is set. Plain ASGI so streamed responses are timed
+    to their last chunk.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        stats = RequestStats(time.perf_counter(), statements=[] if profiling.QUERY_PROFILING else None)
+        token = _request_stats.set(stats)
+        status = 500
+
+        async def send_with_metrics(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                if SERVER_TIMING:
+                    message['headers'] = list(message.get('headers', [])) + [(b'server-timing', stats.server_timing().encode('latin-1'))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            _request_stats.reset(token)
+            # FastAPI puts the matched route in the scope
+            route = getattr(scope.get('route'), 'path', 'unmatched')
+            REQUEST_LATENCY.labels(scope['method'], route, str(status)).observe(time.perf_counter() - stats.start)
+            REQUEST_DB_TIME.labels(route).observe(stats.db_time)
+            REQUEST_DB_QUERIES.labels(route).observe(stats.queries)
+            if stats.statements:
+                profiling.report(f'{scope["method"]} {route}', stats.statements)
+
+
+def instrument_engine(engine):
+    """
+    Times every query, and every wait for a pooled connection, of a (sync) engine.
+    """
+    # Start times by execution context, so a failed query's can be dropped without upsetting the rest
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', {})[context] = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop(context)
+        stats = _request_stats.get()
+        if stats is not None:
+            stats.db_time += elapsed
+            stats.queries += 1
+            if stats.statements is not None:
+                stats.statements.append(statement)
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        # A failed query never reaches after_cursor_execute, so drop its start time here
+        if context.connection is not None:
+            context.connection.info.get('query_start', {}).pop(context.execution_context, None)
+
+    # The pool has no event for the start of a checkout, so time the private method that waits for
+    # one. Pool waits go unmeasured if a pool doesn't have it.
+    pool = engine.pool
+    do_get = getattr(pool, '_do_get', None)
+    if do_get is None:
+        return
+
+    def timed_do_get():
+        start = time.perf_counter()
+        try:
+            return do_get()
+        finally:
+            elapsed = time.perf_counter() - start
+            POOL_CHECKOUT_WAIT.observe(elapsed)
+            stats = _request_stats.get()
+            if stats is not None:
+                stats.pool_wait += elapsed
+
+    pool._do_get = timed_do_get
+
+def observe_llm(start: float, outcome: str, usage=None):
+    """
+    Records an LLM call that started at `start` (perf_counter), and its token usage if given.
+    """
+    elapsed = time.perf_counter() - start
+    prompt = current_prompt.get()
+    LLM_LATENCY.labels(prompt, outcome).observe(elapsed)
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.llm_time += elapsed
+    if usage is not None:
+        for kind in ('input_tokens', 'output_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens'):
+            count = getattr(usage, kind, None)
+            if count:
+                LLM_TOKENS.labels(prompt, kind).inc(count)
+
+def render() -> tuple:
+    """
+    The exposition body and its content type.
+    """
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,78 @@
+"""
+A single LISTEN connection per process, shared by everything that reacts to pg_notify. Handlers
+are called with each payload, and with None whenever the connection is (re)established, since
+anything sent while it was down has been missed.
+"""
+import asyncio
+import logging
+import os
+from collections import defaultdict
+from typing import Callable, Optional
+import asyncpg
+from app.database import engine
+
+NOTIFY_RECONNECT_DELAY = float(os.getenv('NOTIFY_RECONNECT_DELAY', 5))
+
+logger = logging.getLogger(__name__)
+
+_handlers = defaultdict(list)  # channel -> [handler(payload)]
+_connection: Optional[asyncpg.Connection] = None
+
+
+def subscribe(channel: str, handler: Callable[[Optional[str]], None]):
+    new_channel = channel not in _handlers
+    _handlers[channel].append(handler)
+    if new_channel and _connection is not None:
+        asyncio.get_running_loop().create_task(_connection.add_listener(channel, _dispatch))
+
+def unsubscribe(channel: str, handler: Callable[[Optional[str]], None]):
+    if handler in _handlers.get(channel, []):
+        _handlers[channel].remove(handler)
+
+async def listen(stop: asyncio.Event):
+    """
+    Holds the LISTEN connection open until `stop` is set, reconnecting whenever it drops.
+    """
+    global _connection
+    dsn = engine.url.set(drivername='postgresql').render_as_string(hide_password=False)
+    while not stop.is_set():
+        lost = asyncio.Event()
+        connection = None
+        try:
+            connection = await asyncpg.connect(dsn)
+            connection.add_termination_listener(lambda _: lost.set())
+            for channel in list(_handlers):
+                await connection.add_listener(channel, _dispatch)
+        except Exception:
+            if connection is not None:
+                connection.terminate()
+            logger.exception('Could not LISTEN, retrying in %ss', NOTIFY_RECONNECT_DELAY)
+            await _wait_any(stop, timeout=NOTIFY_RECONNECT_DELAY)
+            continue
+
+        _connection = connection
+        for channel in list(_handlers):
+            _call_handlers(channel, None)
+        await _wait_any(stop, lost)
+        _connection = None
+        if not connection.is_closed():
+            await connection.close()
+
+
+def _dispatch(connection, pid: int, channel: str, payload: str):
+    _call_handlers(channel, payload)
+
+def _call_handlers(channel: str, payload: Optional[str]):
+    for handler in list(_handlers.get(channel, [])):
+        try:
+            handler(payload)
+        except Exception:
+            logger.exception('Notification handler for %s failed', channel)
+
+async def _wait_any(*events: asyncio.Event, timeout: float = None):
+    waiters = [asyncio.ensure_future(event.wait()) for event in events]
+    try:
+        await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for waiter in waiters:
+            waiter.cancel()
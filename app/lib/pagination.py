@@ -0,0 +1,59 @@
+"""
+Opaque cursors for keyset pagination. A cursor holds the sort key and id of the last row on a page,
+and the next page starts right after it, so every page costs the same however deep it is.
+"""
+import base64
+import json
+from datetime import datetime
+from sqlalchemy import and_, or_
+
+# The range of the integer columns. asyncpg raises a DataError for values outside it.
+INT4_MIN = -2 ** 31
+INT4_MAX = 2 ** 31 - 1
+
+
+def encode_cursor(position: dict) -> str:
+    data = json.dumps(position, default=_encode_value, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor: str) -> dict:
+    """
+    Raises ValueError if the cursor is malformed.
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        position = json.loads(data, object_hook=_decode_value)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError('Invalid cursor') from e
+    if not isinstance(position, dict):
+        raise ValueError('Invalid cursor')
+    return position
+
+def is_cursor_value(value, types) -> bool:
+    """
+    Whether a decoded id or sort key is one of `types`, and in range if it is an int, so a
+    tampered cursor gets a 400 rather than failing in the database.
+    """
+    # bool is an int to isinstance, but never a valid key or id
+    if isinstance(value, bool) or not isinstance(value, types):
+        return False
+    return not isinstance(value, int) or INT4_MIN <= value <= INT4_MAX
+
+def keyset_after(key, id_column, value, last_id):
+    """
+    Filters to rows after (value, last_id) in `ORDER BY key, id_column` order. NULL keys sort last,
+    as Postgres does for ascending order.
+    """
+    if value is None:
+        return and_(key.is_(None), id_column > last_id)
+    return or_(key > value, and_(key == value, id_column > last_id), key.is_(None))
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {'$dt': value.isoformat()}
+    raise TypeError(f'Cannot encode {type(value).__name__} in a cursor')
+
+def _decode_value(obj: dict):
+    if set(obj) == {'$dt'}:
+        return datetime.fromisoformat(obj['$dt'])
+    return obj
@@ -0,0 +1,67 @@
+"""
+Query profiling. With QUERY_PROFILING=true every statement a request runs is captured (see
+`metrics.MetricsMiddleware`), and statement shapes repeated QUERY_REPEAT_THRESHOLD or more times
+within one request, the usual sign of an N+1, are logged with the route.
+
+`query_budget` fails a block of code that runs more queries than allowed, see the fixture of the
+same name in tests/conftest.py.
+"""
+import logging
+import os
+import re
+from collections import Counter
+from contextlib import contextmanager
+from typing import List, Tuple
+from sqlalchemy import event
+
+QUERY_PROFILING = os.getenv('QUERY_PROFILING', 'false').lower() == 'true'
+QUERY_REPEAT_THRESHOLD = int(os.getenv('QUERY_REPEAT_THRESHOLD', 3))
+
+logger = logging.getLogger(__name__)
+
+# Runs of bind parameters, so IN lists of any length have the same shape
+PARAMETERS = re.compile(r'(?:\$\d+|%\(\w+\)s|\?)(?:\s*,\s*(?:\$\d+|%\(\w+\)s|\?))*')
+WHITESPACE = re.compile(r'\s+')
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def statement_shape(statement: str) -> str:
+    return PARAMETERS.sub('?', WHITESPACE.sub(' ', statement).strip())
+
+def repeated_shapes(statements: List[str], threshold: int = QUERY_REPEAT_THRESHOLD) -> List[Tuple[str, int]]:
+    counts = Counter(statement_shape(statement) for statement in statements)
+    return [(shape, count) for shape, count in counts.most_common() if count >= threshold]
+
+def report(route: str, statements: List[str]):
+    for shape, count in repeated_shapes(statements):
+        logger.warning('Possible N+1 in %s: %s queries of the same shape: %s', route, count, shape)
+
+@contextmanager
+def query_budget(max_queries: int, engine=None):
+    """
+    Raises QueryBudgetExceeded, listing the statements, if the block runs more than `max_queries`
+    queries on `engine` (the app's by default). Yields the list the statements are collected in.
+
+        with query_budget(2):
+            await client.get('/api/v1/tasks/')
+    """
+    if engine is None:
+        # Imported here since app.database imports this module, through metrics
+        from app.database import engine
+    sync_engine = getattr(engine, 'sync_engine', engine)
+    statements = []
+
+    def collect(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(sync_engine, 'before_cursor_execute', collect)
+    try:
+        yield statements
+    finally:
+        event.remove(sync_engine, 'before_cursor_execute', collect)
+    if len(statements) > max_queries:
+        listing = '\n'.join(f'  {statement_shape(statement)}' for statement in statements)
+        raise QueryBudgetExceeded(f'{len(statements)} queries, budget is {max_queries}:\n{listing}')
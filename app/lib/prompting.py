@@ -0,0 +1,32 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database import Task, TaskPrompt, CreditTransaction
+from app.lib import versions
+from app.lib.catalog import Prompt
+
+
+def format_prompt(prompt: Prompt, task: Task) -> str:
+    """
+    Renders the variable part of the prompt. `prompt.instructions` go separately as the system prompt.
+    """
+    return prompt.template.render(task_variables(task))
+
+def task_variables(task: Task) -> dict:
+    return {
+        'task_description': task.description,
+        'location': task.location or '',
+        'categories': ', '.join(task.categories or []),
+        'date_due': task.date_due.strftime('%Y-%m-%d %H:%M UTC') if task.date_due else '',
+    }
+
+async def save_result(db: AsyncSession, prompt: Prompt, task_id: int, result: str, transaction: CreditTransaction) -> TaskPrompt:
+    """
+    Stores the LLM result and links it to the credits reserved for it (see `credits.reserve`).
+    """
+    await versions.touch_tasks(db, transaction.user_id)
+    task_prompt = TaskPrompt(task_id=task_id, ai_prompt_id=prompt.id, result=result)
+    db.add(task_prompt)
+    await db.flush()
+    transaction.task_prompt_id = task_prompt.id
+    await db.commit()
+    await db.refresh(task_prompt)
+    return task_prompt
@@ -0,0 +1,130 @@
+"""
+Admission control for prompt runs. Each run takes a token from two buckets, one for the user and
+one for the AIPrompt, which refill at a steady rate up to a burst size. Runs over either limit
+get a 429, and runs that would only join a full LLM queue (see `llm.overloaded`) a 503, both
+with Retry-After, so spikes are turned away quickly instead of queuing until they time out.
+
+Buckets are kept per worker, or in Postgres with RATE_LIMIT_DB=true so limits hold across workers.
+"""
+import math
+import os
+import time
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+from fastapi import HTTPException, status
+from sqlalchemy import bindparam, text, Float
+from app.database import SessionLocal
+from app.lib import llm, metrics
+from app.lib.cache import TTLCache
+
+LLM_RATE_LIMITS = os.getenv('LLM_RATE_LIMITS', 'true').lower() == 'true'
+# Runs per minute, and how many can be made at once after a quiet spell
+LLM_USER_RATE = float(os.getenv('LLM_USER_RATE', 10))
+LLM_USER_BURST = float(os.getenv('LLM_USER_BURST', 5))
+LLM_PROMPT_RATE = float(os.getenv('LLM_PROMPT_RATE', 300))
+LLM_PROMPT_BURST = float(os.getenv('LLM_PROMPT_BURST', 50))
+LLM_OVERLOADED_RETRY_AFTER = int(os.getenv('LLM_OVERLOADED_RETRY_AFTER', 5))
+RATE_LIMIT_DB = os.getenv('RATE_LIMIT_DB', 'false').lower() == 'true'
+RATE_LIMIT_CACHE_SIZE = int(os.getenv('RATE_LIMIT_CACHE_SIZE', 10000))
+
+# Refills the bucket and takes a token from it, unless that would leave less than none. Returns
+# no row if the bucket is empty, leaving the row locked until the transaction ends.
+TAKE_TOKEN = text("""
+    INSERT INTO rate_limit_buckets AS b (key, tokens, refilled_at)
+    VALUES (:key, :burst - 1, EXTRACT(EPOCH FROM clock_timestamp()))
+    ON CONFLICT (key) DO UPDATE SET
+        tokens = LEAST(:burst, b.tokens + (EXCLUDED.refilled_at - b.refilled_at) * :rate) - 1,
+        refilled_at = EXCLUDED.refilled_at
+    WHERE LEAST(:burst, b.tokens + (EXCLUDED.refilled_at - b.refilled_at) * :rate) >= 1
+    RETURNING tokens
+""").bindparams(bindparam('rate', type_=Float), bindparam('burst', type_=Float))
+BUCKET_TOKENS = text("""
+    SELECT LEAST(:burst, tokens + (EXTRACT(EPOCH FROM clock_timestamp()) - refilled_at) * :rate)
+    FROM rate_limit_buckets WHERE key = :key
+""").bindparams(bindparam('rate', type_=Float), bindparam('burst', type_=Float))
+
+
+@dataclass(frozen=True)
+class Limit:
+    name: str  # 'user' or 'prompt', for metrics
+    key: str
+    rate: float  # Tokens per second
+    burst: float
+
+
+# key -> (tokens, refilled_at by time.monotonic). Entries expire once the bucket would be full again.
+_buckets = TTLCache(RATE_LIMIT_CACHE_SIZE, 60)
+
+
+async def admit(user_id: int, prompt_id: int, endpoint: str, capacity: bool = True):
+    """
+    Raises a 503 if the LLM queue is full (only with `capacity`, for runs made in the request),
+    or a 429 if the user or the prompt is over its rate limit. Call before reserving credits.
+    """
+    if capacity and llm.overloaded():
+        metrics.LLM_REJECTIONS.labels(endpoint, 'overloaded').inc()
+        raise overloaded_error()
+    if not LLM_RATE_LIMITS:
+        return
+    denied = await take(prompt_limits(user_id, prompt_id))
+    if denied is not None:
+        limit, retry_after = denied
+        metrics.LLM_REJECTIONS.labels(endpoint, limit.name).inc()
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many prompt runs, try again later",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+
+def overloaded_error() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Too many prompt runs in progress, try again shortly",
+        headers={"Retry-After": str(LLM_OVERLOADED_RETRY_AFTER)},
+    )
+
+def prompt_limits(user_id: int, prompt_id: int) -> List[Limit]:
+    limits = []
+    if LLM_USER_RATE > 0:
+        limits.append(Limit('user', f'user:{user_id}', LLM_USER_RATE / 60, max(1, LLM_USER_BURST)))
+    if LLM_PROMPT_RATE > 0:
+        limits.append(Limit('prompt', f'prompt:{prompt_id}', LLM_PROMPT_RATE / 60, max(1, LLM_PROMPT_BURST)))
+    return limits
+
+async def take(limits: List[Limit]) -> Optional[Tuple[Limit, float]]:
+    """
+    Takes a token from every bucket, or from none of them if any is empty. Returns None on
+    success, otherwise an empty bucket's limit and the seconds until it has a token again.
+    """
+    if not limits:
+        return None
+    if RATE_LIMIT_DB:
+        return await _take_db(limits)
+    return _take_memory(limits)
+
+
+def _take_memory(limits: List[Limit]) -> Optional[Tuple[Limit, float]]:
+    # No awaits, so this is atomic within the worker
+    now = time.monotonic()
+    levels = []
+    for limit in limits:
+        tokens, refilled_at = _buckets.get(limit.key, (limit.burst, now))
+        tokens = min(limit.burst, tokens + (now - refilled_at) * limit.rate)
+        if tokens < 1:
+            return limit, (1 - tokens) / limit.rate
+        levels.append(tokens)
+    for limit, tokens in zip(limits, levels):
+        _buckets.set(limit.key, (tokens - 1, now), ttl=(limit.burst - tokens + 1) / limit.rate)
+    return None
+
+async def _take_db(limits: List[Limit]) -> Optional[Tuple[Limit, float]]:
+    async with SessionLocal() as db:
+        # Rolled back unless every bucket has a token. Locked in key order so concurrent runs can't deadlock.
+        for limit in sorted(limits, key=lambda limit: limit.key):
+            params = {"key": limit.key, "rate": limit.rate, "burst": limit.burst}
+            if (await db.execute(TAKE_TOKEN, params)).first() is None:
+                tokens = await db.scalar(BUCKET_TOKENS, params)
+                await db.rollback()
+                return limit, (1 - tokens) / limit.rate
+        await db.commit()
+    return None
@@ -0,0 +1,179 @@
+"""
+Retry, hedging and circuit breaking for calls to an unreliable upstream, see `llm.policy`.
+
+A `Policy` runs a call against an overall deadline:
+- Failures the upstream might recover from are retried after a jittered exponential backoff, or
+  the upstream's Retry-After, as long as the retry can start before the deadline.
+- With `hedge`, a second request is sent if the first is slower than the p95 of recent calls,
+  and whichever succeeds first is used.
+- A `CircuitBreaker` opens after a run of failures and fails calls fast for a cooldown, then lets
+  a single trial call through to see whether the upstream has recovered.
+"""
+import asyncio
+import math
+import random
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional
+
+
+class CircuitOpen(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f'Circuit open, retry in {retry_after:.1f}s')
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Opens after `failures` consecutive failures and rejects calls for `cooldown` seconds. After
+    that one trial call is let through: success closes the circuit, failure opens it again.
+    Not thread safe, it is meant to be used from the event loop.
+    """
+    def __init__(self, failures: int, cooldown: float):
+        self.failures = failures
+        self.cooldown = cooldown
+        self._consecutive = 0
+        self._opened_at = None
+        self._trial = False
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return 'closed'
+        return 'open' if time.monotonic() - self._opened_at < self.cooldown else 'half_open'
+
+    def before_call(self):
+        """
+        Raises CircuitOpen unless the call may go ahead. Report how it went with `success`,
+        `failure` or `release`.
+        """
+        state = self.state
+        if state == 'open':
+            raise CircuitOpen(self._opened_at + self.cooldown - time.monotonic())
+        if state == 'half_open':
+            if self._trial:
+                raise CircuitOpen(1)
+            self._trial = True
+
+    def success(self):
+        self._consecutive = 0
+        self._opened_at = None
+        self._trial = False
+
+    def failure(self):
+        self._consecutive += 1
+        if self._trial or self._consecutive >= self.failures:
+            self._opened_at = time.monotonic()
+        self._trial = False
+
+    def release(self):
+        # The call ended in a way that says nothing about the upstream, like a bad request
+        self._trial = False
+
+
+class LatencySample:
+    """
+    The durations of the most recent successful calls.
+    """
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._durations = deque(maxlen=size)
+
+    def add(self, duration: float):
+        self._durations.append(duration)
+
+    def percentile(self, p: float) -> Optional[float]:
+        if len(self._durations) < self.min_samples:
+            return None
+        ordered = sorted(self._durations)
+        return ordered[min(len(ordered) - 1, math.ceil(len(ordered) * p / 100) - 1)]
+
+
+@dataclass
+class Policy:
+    retries: int
+    base_delay: float
+    max_delay: float
+    retryable: Callable[[BaseException], bool]
+    retry_after: Callable[[BaseException], Optional[float]] = lambda e: None
+    breaker: Optional[CircuitBreaker] = None
+    hedge: bool = False
+    hedge_percentile: float = 95
+    on_event: Callable[[str], None] = lambda event: None  # 'retry', 'hedge' or 'circuit_open'
+    latencies: LatencySample = field(default_factory=LatencySample)
+
+    async def run(self, call: Callable[[float], Awaitable], timeout: float, hedge: bool = None):
+        """
+        Returns the result of `call(seconds_left)`, retrying and hedging as configured, or raises
+        the last failure. Gives up once `timeout` seconds have passed. Pass `hedge=False` for calls
+        that can't safely be made twice at once.
+        """
+        deadline = time.monotonic() + timeout
+        hedge = self.hedge if hedge is None else hedge
+        attempt = 0
+        while True:
+            if self.breaker is not None:
+                try:
+                    self.breaker.before_call()
+                except CircuitOpen:
+                    self.on_event('circuit_open')
+                    raise
+            try:
+                result = await self._attempt(call, deadline, hedge)
+            except Exception as e:
+                failed = self.retryable(e)
+                if self.breaker is not None:
+                    self.breaker.failure() if failed else self.breaker.release()
+                if not failed or attempt >= self.retries:
+                    raise
+                delay = max(self.backoff(attempt), self.retry_after(e) or 0)
+                if time.monotonic() + delay >= deadline:
+                    raise
+                attempt += 1
+                self.on_event('retry')
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                if self.breaker is not None:
+                    self.breaker.release()
+                raise
+            if self.breaker is not None:
+                self.breaker.success()
+            return result
+
+    def backoff(self, attempt: int) -> float:
+        # "Full jitter", so clients that failed together don't retry together
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def _attempt(self, call: Callable[[float], Awaitable], deadline: float, hedge: bool):
+        hedge_after = self.latencies.percentile(self.hedge_percentile) if hedge else None
+        requests = [asyncio.ensure_future(self._timed(call, deadline))]
+        try:
+            if hedge_after is not None and time.monotonic() + hedge_after < deadline:
+                done, _ = await asyncio.wait(requests, timeout=hedge_after)
+                if not done:
+                    self.on_event('hedge')
+                    requests.append(asyncio.ensure_future(self._timed(call, deadline)))
+            # The first success wins. If every request fails, the last failure is raised.
+            pending = set(requests)
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for request in done:
+                    if request.exception() is None or not pending:
+                        return request.result()
+        finally:
+            for request in requests:
+                if request.done() and not request.cancelled():
+                    request.exception()  # Retrieved, so a losing failure isn't logged as unhandled
+                else:
+                    request.cancel()
+
+    async def _timed(self, call: Callable[[float], Awaitable], deadline: float):
+        start = time.monotonic()
+        left = deadline - start
+        if left <= 0:
+            raise asyncio.TimeoutError()
+        result = await asyncio.wait_for(call(left), left)
+        self.latencies.add(time.monotonic() - start)
+        return result
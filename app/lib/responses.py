@@ -0,0 +1,34 @@
+"""
+Fast path for list endpoints. Rows are selected as tuples of just the response columns and
+encoded straight to JSON with orjson, skipping ORM objects and a second round of validation
+through the response model. Routes keep their response_model for the OpenAPI schema.
+"""
+from typing import Iterable, List, Type
+from fastapi import Response
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
+
+
+def response_columns(model: Type[BaseModel], entity) -> List:
+    """
+    The columns of `entity` behind each field of `model`, in field order.
+    """
+    return [getattr(entity, name) for name in model.model_fields]
+
+def row_dicts(model: Type[BaseModel], rows: Iterable) -> List[dict]:
+    """
+    Rows selected with `response_columns(model, ...)` as dicts. Any extra trailing columns, like a
+    sort key, are left out.
+    """
+    names = list(model.model_fields)
+    return [dict(zip(names, row)) for row in rows]
+
+def rows_response(model: Type[BaseModel], rows: Iterable, response: Response = None) -> ORJSONResponse:
+    """
+    Encodes rows selected with `response_columns(model, ...)`. Headers set on the route's
+    `response` are carried over, since FastAPI drops them when a route returns its own response.
+    """
+    return ORJSONResponse(
+        row_dicts(model, rows),
+        headers=dict(response.headers) if response is not None else None,
+    )
@@ -0,0 +1,123 @@
+"""
+Bulk export and import of tasks. Exports stream from a server-side cursor and imports are COPYed
+into a staging table in batches, so neither holds more than a batch of rows in memory.
+"""
+import codecs
+import csv
+import io
+import itertools
+import json
+from datetime import datetime
+from typing import BinaryIO, Iterator, Type
+from pydantic import BaseModel, ValidationError
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+from app.database import SessionLocal, Task, naive_utc
+from app.lib import versions
+
+EXPORT_BATCH_SIZE = 1000
+IMPORT_BATCH_SIZE = 5000
+
+EXPORT_COLUMNS = ['id', 'description', 'location', 'priority', 'date_added', 'date_due', 'date_completed', 'status', 'categories']
+IMPORT_COLUMNS = ['description', 'location', 'priority', 'date_added', 'date_due', 'date_completed', 'status', 'categories']
+DATE_COLUMNS = {'date_added', 'date_due', 'date_completed'}
+
+CREATE_STAGING = text("""
+    CREATE TEMPORARY TABLE task_import (
+        description varchar,
+        location varchar,
+        priority integer,
+        date_added timestamp,
+        date_due timestamp,
+        date_completed timestamp,
+        status varchar,
+        categories varchar[]
+    ) ON COMMIT DROP
+""")
+
+MERGE_STAGING = text("""
+    INSERT INTO tasks (description, location, priority, date_added, date_due, date_completed, status, categories, owner_id)
+    SELECT description, location, priority, COALESCE(date_added, NOW()), date_due, date_completed, status, categories, :owner_id
+    FROM task_import
+""")
+
+
+class TaskImportError(ValueError):
+    pass
+
+
+async def export_tasks(owner_id: int, format: str):
+    """
+    Yields the user's tasks, completed ones included, as NDJSON or CSV. Opens its own session
+    since the request's is closed before a streaming body runs.
+    """
+    query = select(*(getattr(Task, name) for name in EXPORT_COLUMNS)).where(Task.owner_id == owner_id).order_by(Task.id)
+    async with SessionLocal() as db:
+        result = await db.stream(query.execution_options(yield_per=EXPORT_BATCH_SIZE))
+        if format == 'csv':
+            yield format_csv([EXPORT_COLUMNS])
+        async for rows in result.partitions():
+            yield format_csv(rows) if format == 'csv' else format_ndjson(rows)
+
+def format_ndjson(rows) -> str:
+    return ''.join(json.dumps(dict(row._mapping), default=_encode_value) + '\n' for row in rows)
+
+def format_csv(rows) -> str:
+    out = io.StringIO()
+    writer = csv.writer(out)
+    for row in rows:
+        writer.writerow(_csv_value(value) for value in row)
+    return out.getvalue()
+
+async def import_tasks(db: AsyncSession, owner_id: int, file: BinaryIO, format: str, model: Type[BaseModel]) -> int:
+    """
+    Loads an uploaded NDJSON or CSV file into the user's tasks and returns how many were added.
+    Each row is validated with `model`. Raises TaskImportError on the first invalid row, leaving
+    the transaction to be rolled back. Bumps the user's task version, see `versions.touch_tasks`.
+    """
+    await db.execute(CREATE_STAGING)
+    conn = await (await db.connection()).get_raw_connection()
+    records = parse_tasks(codecs.iterdecode(file, 'utf-8-sig'), format, model)
+    while True:
+        # Parsing reads the spooled upload from disk, so keep it off the event loop
+        try:
+            batch = await run_in_threadpool(list, itertools.islice(records, IMPORT_BATCH_SIZE))
+        except (csv.Error, UnicodeDecodeError) as e:
+            raise TaskImportError(str(e)) from e
+        if not batch:
+            break
+        await conn.driver_connection.copy_records_to_table('task_import', records=batch, columns=IMPORT_COLUMNS)
+    # Only now, so the user's row isn't locked while the upload is parsed and copied
+    await versions.touch_tasks(db, owner_id)
+    result = await db.execute(MERGE_STAGING, {"owner_id": owner_id})
+    return result.rowcount
+
+def parse_tasks(lines: Iterator[str], format: str, model: Type[BaseModel]) -> Iterator[tuple]:
+    rows = csv.DictReader(lines) if format == 'csv' else (line for line in lines if line.strip())
+    for number, row in enumerate(rows, start=1):
+        try:
+            row = _from_csv(row) if format == 'csv' else json.loads(row)
+            task = model.model_validate(row).model_dump()
+        except (ValueError, ValidationError) as e:
+            raise TaskImportError(f'Row {number}: {e}') from e
+        yield tuple(naive_utc(task[name]) if name in DATE_COLUMNS else task[name] for name in IMPORT_COLUMNS)
+
+
+def _from_csv(row: dict) -> dict:
+    # Empty cells fall back to the model defaults; categories are a JSON list, as exported
+    row = {name: value for name, value in row.items() if name in IMPORT_COLUMNS and value}
+    if 'categories' in row:
+        row['categories'] = json.loads(row['categories'])
+    return row
+
+def _csv_value(value):
+    if isinstance(value, list):
+        return json.dumps(value)
+    return _encode_value(value) if isinstance(value, datetime) else value
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'Cannot encode {type(value).__name__}')
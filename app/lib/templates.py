@@ -0,0 +1,23 @@
+"""
+Prompt templates, split into literal text and placeholders once so rendering is a single join.
+Only the placeholders in VARIABLES are substituted; other braces, like the JSON examples in some
+prompts, are left as they are.
+"""
+import re
+from typing import Mapping
+
+VARIABLES = ('task_description', 'location', 'categories', 'date_due')
+PLACEHOLDER = re.compile(r'\{(' + '|'.join(VARIABLES) + r')\}')
+
+
+class Template:
+    def __init__(self, source: str):
+        self.source = source
+        # Literal text at even indexes, variable names at odd ones
+        self.parts = tuple(PLACEHOLDER.split(source))
+        self.variables = frozenset(self.parts[1::2])
+
+    def render(self, values: Mapping[str, str]) -> str:
+        parts = list(self.parts)
+        parts[1::2] = [values[name] for name in self.parts[1::2]]
+        return ''.join(parts)
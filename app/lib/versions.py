@@ -0,0 +1,56 @@
+"""
+Version counters behind the ETags of polled listings. Each user has a task version, bumped with
+every change to their tasks or prompt results, and the prompt catalog has one bumped by a trigger
+on ai_prompts. A poll that hasn't missed a change is answered with a 304 after a single primary
+key lookup, before the listing is queried.
+"""
+from typing import Optional
+from fastapi import HTTPException, Request, Response
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database import User, CatalogVersion
+
+
+async def touch_tasks(db: AsyncSession, user_id: int):
+    """
+    Call in any transaction that writes the user's tasks or prompt results, before the first such
+    write (but after slow work like parsing an upload). This locks the user's row until commit,
+    so the change versions of their rows are taken in commit order and
+    `GET /tasks/changes` can't pass over one that commits late. A trigger notifies the new version
+    to the user's event streams on commit (see `events`).
+    """
+    await db.execute(
+        update(User).where(User.id == user_id).values(task_version=User.task_version + 1),
+        execution_options={"synchronize_session": False},
+    )
+
+async def task_version(db: AsyncSession, user_id: int) -> int:
+    return await db.scalar(select(User.task_version).where(User.id == user_id))
+
+async def catalog_version(db: AsyncSession, name: str = 'ai_prompts') -> int:
+    return await db.scalar(select(CatalogVersion.version).where(CatalogVersion.name == name))
+
+def etag(*parts) -> str:
+    return 'W/"' + '-'.join(str(part) for part in parts) + '"'
+
+def check_not_modified(request: Request, response: Response, tag: str):
+    """
+    Raises a 304 if the client already has this version, otherwise sets the ETag on the response.
+    """
+    headers = {"ETag": tag, "Cache-Control": "private, no-cache"}
+    if _matches(request.headers.get('if-none-match'), tag):
+        raise HTTPException(status_code=304, headers=headers)
+    response.headers.update(headers)
+
+
+def _matches(if_none_match: Optional[str], tag: str) -> bool:
+    # If-None-Match uses weak comparison, so W/ prefixes are ignored
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return _opaque(tag) in {_opaque(candidate) for candidate in if_none_match.split(',')}
+
+def _opaque(tag: str) -> str:
+    tag = tag.strip()
+    return tag[2:] if tag.startswith('W/') else tag
@@ -1,13 +1,36 @@
 from dotenv import load_dotenv
 load_dotenv()
 
-from app.auth import verify_password, create_access_token, get_password_hash
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from app.auth import verify_password, create_access_token
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.database import User, get_db
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, Response, status
 from fastapi.middleware.cors import CORSMiddleware
 from app.api.v1.api import api_router
+from app import worker
+from app.lib import catalog, events, metrics, notify
+
+PROMPT_JOB_WORKERS = int(os.getenv('PROMPT_JOB_WORKERS', 0))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Optionally run prompt job workers in-process instead of via `python -m app.worker`
+    stop = asyncio.Event()
+    catalog.watch()
+    events.watch()
+    listener = asyncio.create_task(notify.listen(stop))
+    workers = asyncio.create_task(worker.run(PROMPT_JOB_WORKERS, stop)) if PROMPT_JOB_WORKERS else None
+    yield
+    stop.set()
+    await listener
+    if workers:
+        await workers
 
 
 app = FastAPI(
@@ -17,6 +40,7 @@ app = FastAPI(
         "name": "Apache 2.0",
         "url": "https://www.apache.org/licenses/LICENSE-2.0.html",
     },
+    lifespan=lifespan,
 )
 
 # Configure CORS
@@ -26,18 +50,26 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Allows all methods
     allow_headers=["*"],  # Allows all headers
+    expose_headers=["X-Next-Cursor", "ETag"],
 )
 
+app.add_middleware(metrics.MetricsMiddleware)
+
 app.include_router(api_router, prefix="/api/v1")
 
 @app.get("/")
 async def root():
     return {"message": "Hello World"}
 
+@app.get("/metrics", include_in_schema=False)
+async def read_metrics():
+    body, content_type = metrics.render()
+    return Response(body, media_type=content_type)
+
 @app.post("/token")
-async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.email == form_data.username).first()
-    if not user or not verify_password(form_data.password, user.hashed_password, user.salt):
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
+    user = await db.scalar(select(User).where(User.email == form_data.username))
+    if not user or not await verify_password(form_data.password, user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
@@ -0,0 +1,22 @@
+"""
+Rebuilds every user's credit balance from the credit_transactions ledger:
+
+    python -m app.reconcile
+"""
+from dotenv import load_dotenv
+load_dotenv()
+
+import asyncio
+from app.database import SessionLocal
+from app.lib import credits
+
+
+async def main():
+    async with SessionLocal() as db:
+        corrected = await credits.reconcile(db)
+        await db.commit()
+    print(f'Corrected {corrected} credit balances')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
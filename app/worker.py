@@ -0,0 +1,140 @@
+"""
+Runs queued prompt jobs. Start standalone workers with:
+
+    python -m app.worker
+
+or set PROMPT_JOB_WORKERS to run them inside the API process.
+"""
+from dotenv import load_dotenv
+load_dotenv()
+
+import asyncio
+import logging
+import os
+import signal
+from sqlalchemy import func, text
+from sqlalchemy.orm import selectinload
+from app.database import SessionLocal, PromptJob, Task
+from app.lib import catalog, credits, llm, metrics, notify, prompting
+
+PROMPT_JOB_CONCURRENCY = int(os.getenv('PROMPT_JOB_CONCURRENCY', 4))
+PROMPT_JOB_POLL_INTERVAL = float(os.getenv('PROMPT_JOB_POLL_INTERVAL', 1))
+PROMPT_JOB_TIMEOUT = int(os.getenv('PROMPT_JOB_TIMEOUT', 300))
+PROMPT_JOB_MAX_ATTEMPTS = int(os.getenv('PROMPT_JOB_MAX_ATTEMPTS', 3))
+
+logger = logging.getLogger(__name__)
+
+# Jobs left 'running' by a crashed worker are picked up again once they go stale
+CLAIM_JOB = text("""
+    UPDATE prompt_jobs SET status = 'running', attempts = attempts + 1, date_started = NOW()
+    WHERE id = (
+        SELECT id FROM prompt_jobs
+        WHERE status = 'queued' OR (status = 'running' AND date_started < NOW() - make_interval(secs => :timeout))
+        ORDER BY id
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, attempts
+""")
+
+
+async def claim_job():
+    async with SessionLocal() as db:
+        row = (await db.execute(CLAIM_JOB, {"timeout": float(PROMPT_JOB_TIMEOUT)})).first()
+        await db.commit()
+        return row
+
+async def finish_job(db, job: PromptJob, status: str, error: str = None, task_prompt_id: int = None):
+    if status == 'failed' and job.credit_transaction is not None:
+        await credits.release(db, job.credit_transaction)
+    job.status = status
+    job.error = error
+    job.task_prompt_id = task_prompt_id
+    job.date_completed = func.now()
+    await db.commit()
+
+async def run_job(job_id: int, attempts: int):
+    async with SessionLocal() as db:
+        job = await db.get(PromptJob, job_id, options=[selectinload(PromptJob.credit_transaction)])
+        if job is None:
+            # The task was deleted while the job was queued
+            return
+        transaction = job.credit_transaction
+        if transaction is not None and transaction.task_prompt_id is not None:
+            # A previous attempt saved its result but died before finishing the job
+            await finish_job(db, job, 'succeeded', task_prompt_id=transaction.task_prompt_id)
+            return
+        if attempts > PROMPT_JOB_MAX_ATTEMPTS:
+            await finish_job(db, job, 'failed', 'Too many attempts')
+            return
+        prompt = await catalog.get_prompt(job.ai_prompt_id)
+        if prompt is None:
+            await finish_job(db, job, 'failed', 'Prompt not found')
+            return
+        task = await db.get(Task, job.task_id)
+        if transaction is None:
+            reservation = await credits.reserve(db, job.user_id, prompt.cost)
+            if reservation is None:
+                metrics.CREDIT_REJECTIONS.labels('worker').inc()
+                await finish_job(db, job, 'failed', 'Insufficient credits')
+                return
+            transaction = job.credit_transaction = reservation[0]
+        formatted_prompt = prompting.format_prompt(prompt, task)
+        # Don't hold a connection while waiting on the LLM
+        await db.commit()
+
+        metrics.current_prompt.set(prompt.name)
+        try:
+            result = await llm.ainvoke(formatted_prompt, cache=prompt.cacheable, system=prompt.instructions)
+        except Exception as e:
+            logger.exception('Prompt job %s failed', job_id)
+            await finish_job(db, job, 'failed', str(e))
+            return
+
+        try:
+            task_prompt = await prompting.save_result(db, prompt, job.task_id, result, transaction)
+        except Exception as e:
+            logger.exception('Saving the result of prompt job %s failed', job_id)
+            await db.rollback()
+            # The job is gone if its task was deleted meanwhile, but the reservation is still there
+            job = await db.get(PromptJob, job_id, options=[selectinload(PromptJob.credit_transaction)], populate_existing=True)
+            if job is None:
+                await db.refresh(transaction)
+                await credits.release(db, transaction)
+                await db.commit()
+            else:
+                await finish_job(db, job, 'failed', str(e))
+            return
+        await finish_job(db, job, 'succeeded', task_prompt_id=task_prompt.id)
+
+async def work(stop: asyncio.Event):
+    while not stop.is_set():
+        try:
+            claimed = await claim_job()
+            if claimed is not None:
+                await run_job(claimed.id, claimed.attempts)
+                continue
+        except Exception:
+            logger.exception('Prompt worker error')
+        try:
+            await asyncio.wait_for(stop.wait(), PROMPT_JOB_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+async def run(concurrency: int = PROMPT_JOB_CONCURRENCY, stop: asyncio.Event = None):
+    stop = stop or asyncio.Event()
+    await asyncio.gather(*(work(stop) for _ in range(concurrency)))
+
+async def main():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    logger.info('Starting %s prompt workers', PROMPT_JOB_CONCURRENCY)
+    catalog.watch()
+    await asyncio.gather(notify.listen(stop), run(PROMPT_JOB_CONCURRENCY, stop))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
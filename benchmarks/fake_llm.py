@@ -0,0 +1,106 @@
+"""
+Local stand-ins for the Anthropic API, for checks and load tests that shouldn't call (or pay for)
+the real one. Install the fake client over `app.lib.llm.async_client`:
+
+    llm.async_client = FakeAsyncAnthropic()
+
+Every request's arguments are kept in `calls`.
+
+`FakeServer` serves the Messages API over HTTP instead, so a real client's error handling is
+exercised too, and can be told to fail or stall requests (see tests/test_llm_resilience.py).
+"""
+import asyncio
+from collections import deque
+from types import SimpleNamespace
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+
+class FakeAsyncAnthropic:
+    def __init__(self, response: str = 'Fake response', latency: float = 0):
+        self.response = response
+        self.latency = latency
+        self.calls = []
+        self.messages = SimpleNamespace(create=self._create, stream=self._stream)
+
+    async def _create(self, **kwargs):
+        self.calls.append(kwargs)
+        await asyncio.sleep(self.latency)
+        return _message(self.response)
+
+    def _stream(self, **kwargs):
+        self.calls.append(kwargs)
+        return _FakeStream(self.response, self.latency)
+
+
+class FakeServer:
+    """
+    A FastAPI app answering POST /v1/messages. Each request takes the next (status, latency) step
+    from `script`, and once that runs out succeeds after `latency`. Error statuses are answered
+    with an Anthropic-style error body, and `retry_after` as a Retry-After header if set.
+    """
+    def __init__(self, response: str = 'Fake response', latency: float = 0):
+        self.response = response
+        self.latency = latency
+        self.retry_after = None
+        self.script = deque()
+        self.requests = 0
+        self.app = FastAPI()
+        self.app.post('/v1/messages')(self._messages)
+
+    def fail(self, *steps):
+        """
+        Queues steps: a status code fails a request straight away, a (status, latency) pair after
+        a delay. Status 200 succeeds.
+        """
+        self.script.clear()
+        self.script.extend(step if isinstance(step, tuple) else (step, 0) for step in steps)
+
+    async def _messages(self, request: Request):
+        self.requests += 1
+        body = await request.json()
+        status, latency = self.script.popleft() if self.script else (200, self.latency)
+        await asyncio.sleep(latency)
+        if status != 200:
+            headers = {'retry-after': str(self.retry_after)} if self.retry_after is not None else None
+            return JSONResponse({'type': 'error', 'error': {'type': 'api_error', 'message': f'Injected {status}'}}, status_code=status, headers=headers)
+        return {
+            'id': f'msg_fake_{self.requests}',
+            'type': 'message',
+            'role': 'assistant',
+            'model': body['model'],
+            'content': [{'type': 'text', 'text': self.response}],
+            'stop_reason': 'end_turn',
+            'stop_sequence': None,
+            'usage': {'input_tokens': 100, 'output_tokens': len(self.response.split(' '))},
+        }
+
+
+class _FakeStream:
+    def __init__(self, response: str, latency: float):
+        self.response = response
+        self.latency = latency
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    @property
+    def text_stream(self):
+        return self._text()
+
+    async def get_final_message(self):
+        return _message(self.response)
+
+    async def _text(self):
+        words = self.response.split(' ')
+        for i, word in enumerate(words):
+            await asyncio.sleep(self.latency / len(words))
+            yield word if i == 0 else ' ' + word
+
+
+def _message(text: str):
+    usage = SimpleNamespace(input_tokens=100, output_tokens=len(text.split(' ')), cache_creation_input_tokens=0, cache_read_input_tokens=0)
+    return SimpleNamespace(content=[SimpleNamespace(type='text', text=text)], usage=usage)
@@ -0,0 +1,71 @@
+"""
+Compares the CPU cost of a task list page served from ORM objects validated through the response
+model (the old path) with one served from column tuples encoded by orjson (app.lib.responses).
+Seeds benchmark data first (see benchmarks.seed).
+
+    python -m benchmarks.list_serialization --rows 100 1000
+"""
+from dotenv import load_dotenv
+load_dotenv()
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from typing import List
+from fastapi.responses import JSONResponse
+from pydantic import TypeAdapter
+from sqlalchemy import select
+from app.api.v1.tasks import TaskResponse
+from app.database import SessionLocal, Task
+from app.lib import responses
+from benchmarks.seed import seed, add_arguments
+
+task_list = TypeAdapter(List[TaskResponse])
+
+
+async def orm_page(user_id: int, rows: int) -> bytes:
+    # What FastAPI does with a response_model: validate, dump to JSON types, then json.dumps
+    async with SessionLocal() as db:
+        tasks = (await db.scalars(select(Task).where(Task.owner_id == user_id).order_by(Task.id).limit(rows))).all()
+        return JSONResponse(task_list.dump_python(task_list.validate_python(tasks, from_attributes=True), mode='json')).body
+
+async def lean_page(user_id: int, rows: int) -> bytes:
+    async with SessionLocal() as db:
+        result = await db.execute(
+            select(*responses.response_columns(TaskResponse, Task)).where(Task.owner_id == user_id).order_by(Task.id).limit(rows)
+        )
+        return responses.rows_response(TaskResponse, result).body
+
+async def measure(page, user_id: int, rows: int, iterations: int) -> float:
+    """
+    Median CPU milliseconds per page.
+    """
+    samples = []
+    for _ in range(iterations):
+        start = time.process_time()
+        await page(user_id, rows)
+        samples.append(time.process_time() - start)
+    return round(statistics.median(samples) * 1000, 3)
+
+async def main(args):
+    async with SessionLocal() as db:
+        user_ids = await seed(db, args.users, args.tasks, args.transactions)
+    user_id = user_ids[0]
+    results = {}
+    for rows in args.rows:
+        if json.loads(await orm_page(user_id, rows)) != json.loads(await lean_page(user_id, rows)):
+            raise SystemExit(f'Responses differ for {rows} rows')
+        orm_ms = await measure(orm_page, user_id, rows, args.iterations)
+        lean_ms = await measure(lean_page, user_id, rows, args.iterations)
+        results[rows] = {'orm_cpu_ms': orm_ms, 'lean_cpu_ms': lean_ms, 'speedup': round(orm_ms / lean_ms, 2) if lean_ms else None}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    parser.add_argument('--rows', type=int, nargs='+', default=[100, 1000], help='page sizes')
+    parser.add_argument('--iterations', type=int, default=50)
+    asyncio.run(main(parser.parse_args()))
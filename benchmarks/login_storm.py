@@ -0,0 +1,77 @@
+"""
+Fires a burst of concurrent logins at a running API while probing a cheap endpoint, to check that
+password hashing doesn't stall the rest of the worker.
+
+    python -m benchmarks.login_storm --url http://localhost:8000 --email me@example.com --password secret123
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import httpx
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))] if values else None
+
+async def login(client: httpx.AsyncClient, email: str, password: str):
+    start = time.perf_counter()
+    response = await client.post('/token', data={'username': email, 'password': password})
+    return response.status_code, time.perf_counter() - start
+
+async def probe(client: httpx.AsyncClient, stop: asyncio.Event, interval: float):
+    latencies = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        await client.get('/')
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(interval)
+    return latencies
+
+async def main(args):
+    limits = httpx.Limits(max_connections=args.concurrency + 1)
+    async with httpx.AsyncClient(base_url=args.url, timeout=60, limits=limits) as client:
+        # Make sure the account exists, ignoring "already registered"
+        await client.post('/api/v1/users/', json={'email': args.email, 'password': args.password})
+
+        stop = asyncio.Event()
+        prober = asyncio.create_task(probe(client, stop, args.probe_interval))
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def limited_login():
+            async with semaphore:
+                return await login(client, args.email, args.password)
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(limited_login() for _ in range(args.logins)))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        probe_latencies = await prober
+
+    statuses = {}
+    for code, _ in results:
+        statuses[code] = statuses.get(code, 0) + 1
+    login_latencies = [latency for code, latency in results if code == 200]
+    print(json.dumps({
+        'logins': args.logins,
+        'concurrency': args.concurrency,
+        'statuses': statuses,
+        'logins_per_second': round(len(login_latencies) / elapsed, 2),
+        'login_p50_ms': round(percentile(login_latencies, 50) * 1000, 1) if login_latencies else None,
+        'login_p99_ms': round(percentile(login_latencies, 99) * 1000, 1) if login_latencies else None,
+        'probe_p50_ms': round(statistics.median(probe_latencies) * 1000, 1) if probe_latencies else None,
+        'probe_p99_ms': round(percentile(probe_latencies, 99) * 1000, 1) if probe_latencies else None,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--email', default='login-storm@example.com')
+    parser.add_argument('--password', default='login-storm-password')
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--probe-interval', type=float, default=0.05)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,333 @@
+"""
+Load tests every endpoint against a local Postgres and reports latency, throughput and queries
+per request as JSON, to compare between commits. Runs fully offline: the API is served
+in-process with the LLM client swapped for benchmarks.fake_llm.
+
+    python -m benchmarks.run --output baseline.json
+    python -m benchmarks.run --compare baseline.json
+
+Seeds benchmark data first (see benchmarks.seed). Write scenarios add tasks, prompt results, jobs
+and users, so numbers drift slightly as a database is reused. The delete scenarios get their own
+tasks to delete, added before they are timed.
+"""
+from dotenv import load_dotenv
+load_dotenv()
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import subprocess
+import sys
+import time
+import httpx
+import uvicorn
+from sqlalchemy import event, insert, select
+from app.database import SessionLocal, Task, engine
+from app.lib import catalog, llm, ratelimit
+from app.main import app
+from benchmarks.fake_llm import FakeAsyncAnthropic
+from benchmarks.login_storm import percentile
+from benchmarks.seed import BENCH_EMAIL, BENCH_PASSWORD, seed, add_arguments
+
+TASK_SAMPLE = 200
+DELETE_BULK_SIZE = 10
+IMPORT_SIZE = 100
+
+
+class Context:
+    def __init__(self, user_ids: list, tokens: list, task_ids: list, prompt_ids: list, rng: random.Random):
+        self.user_ids = user_ids
+        self.tokens = tokens  # The first user is an admin
+        self.task_ids = task_ids  # Per user, in the same order as tokens
+        self.prompt_ids = prompt_ids
+        self.rng = rng
+        self.spare_task_ids = [[] for _ in tokens]  # Per user, for the delete scenarios to use up
+        self.job_ids = [[] for _ in tokens]
+
+    def headers(self, n: int) -> dict:
+        return {'Authorization': f'Bearer {self.tokens[n]}'}
+
+    def user(self):
+        """
+        A random user's auth headers and one of their task ids.
+        """
+        n = self.rng.randrange(len(self.tokens))
+        return self.headers(n), self.rng.choice(self.task_ids[n])
+
+    def spare_tasks(self, count: int):
+        """
+        The auth headers of a random user with `count` spare tasks left, and those tasks' ids.
+        """
+        n = self.rng.choice([n for n, ids in enumerate(self.spare_task_ids) if len(ids) >= count])
+        ids = self.spare_task_ids[n]
+        self.spare_task_ids[n], taken = ids[:-count], ids[-count:]
+        return self.headers(n), taken
+
+def new_task(rng: random.Random) -> dict:
+    return {'description': f'benchmark task {rng.randrange(10 ** 6)}', 'location': 'home', 'priority': rng.randrange(6), 'categories': ['work']}
+
+def request(method: str, path: str, body=None, **params):
+    """
+    A scenario making one request as a random user. `{task_id}` and `{prompt_id}` in the path are
+    filled in with one of their tasks and a random prompt, and `body` is a function of the rng.
+    """
+    def send(client: httpx.AsyncClient, ctx: Context):
+        headers, task_id = ctx.user()
+        url = path.format(task_id=task_id, prompt_id=ctx.rng.choice(ctx.prompt_ids))
+        return client.request(method, url, params=params, json=body(ctx.rng) if body else None, headers=headers)
+    return send
+
+def delete_task(client: httpx.AsyncClient, ctx: Context):
+    headers, (task_id,) = ctx.spare_tasks(1)
+    return client.delete(f'/api/v1/tasks/{task_id}', headers=headers)
+
+def delete_task_bulk(client: httpx.AsyncClient, ctx: Context):
+    headers, task_ids = ctx.spare_tasks(DELETE_BULK_SIZE)
+    return client.request('DELETE', '/api/v1/tasks/bulk', json=task_ids, headers=headers)
+
+def import_tasks(client: httpx.AsyncClient, ctx: Context):
+    headers, _ = ctx.user()
+    lines = ''.join(json.dumps(new_task(ctx.rng)) + '\n' for _ in range(IMPORT_SIZE))
+    return client.post('/api/v1/tasks/import', files={'file': ('tasks.ndjson', lines.encode('utf-8'))}, headers=headers)
+
+async def enqueue_job(client: httpx.AsyncClient, ctx: Context):
+    n = ctx.rng.randrange(len(ctx.tokens))
+    url = f'/api/v1/prompts/{ctx.rng.choice(ctx.prompt_ids)}/apply/{ctx.rng.choice(ctx.task_ids[n])}/jobs'
+    response = await client.post(url, headers=ctx.headers(n))
+    if response.status_code == 202:
+        ctx.job_ids[n].append(response.json()['id'])
+    return response
+
+def read_job(client: httpx.AsyncClient, ctx: Context):
+    n = ctx.rng.choice([n for n, ids in enumerate(ctx.job_ids) if ids])
+    return client.get(f'/api/v1/prompts/jobs/{ctx.rng.choice(ctx.job_ids[n])}', headers=ctx.headers(n))
+
+async def first_event(client: httpx.AsyncClient, ctx: Context):
+    # The stream never ends, so this times how long the current version takes to arrive
+    headers, _ = ctx.user()
+    async with client.stream('GET', '/api/v1/events/', headers=headers) as response:
+        async for line in response.aiter_lines():
+            if line.startswith('data:'):
+                break
+    return response
+
+def read_users(client: httpx.AsyncClient, ctx: Context):
+    return client.get('/api/v1/users/', headers=ctx.headers(0))
+
+def read_user(client: httpx.AsyncClient, ctx: Context):
+    return client.get(f'/api/v1/users/{ctx.rng.choice(ctx.user_ids)}', headers=ctx.headers(0))
+
+def create_user(client: httpx.AsyncClient, ctx: Context):
+    return client.post('/api/v1/users/', json={'email': f'bench-new-{ctx.rng.randrange(10 ** 12)}@example.com', 'password': BENCH_PASSWORD})
+
+def update_task_bulk(client: httpx.AsyncClient, ctx: Context):
+    # Dates left unset, as on most open tasks, so whole VALUES columns are NULL
+    headers, task_id = ctx.user()
+    return client.patch('/api/v1/tasks/bulk', json=[{**new_task(ctx.rng), 'id': task_id}], headers=headers)
+
+def login(client: httpx.AsyncClient, ctx: Context):
+    email = BENCH_EMAIL.format(ctx.rng.randrange(len(ctx.tokens)))
+    return client.post('/token', data={'username': email, 'password': BENCH_PASSWORD})
+
+# name -> function of (client, context) making one request
+SCENARIOS = {
+    'GET /': lambda client, ctx: client.get('/'),
+    'POST /token': login,
+    'GET /tasks': request('GET', '/api/v1/tasks/'),
+    'GET /tasks?sort=date_due': request('GET', '/api/v1/tasks/', sort='date_due'),
+    'GET /tasks?filter_name=completed&sort=date_completed&limit=1000': request('GET', '/api/v1/tasks/', filter_name='completed', sort='date_completed', limit=1000),
+    'GET /tasks?skip=5000': request('GET', '/api/v1/tasks/', skip=5000),
+    'GET /tasks?q=grocreies': request('GET', '/api/v1/tasks/', q='grocreies'),
+    'GET /tasks/stats': request('GET', '/api/v1/tasks/stats'),
+    'GET /tasks/changes?limit=100': request('GET', '/api/v1/tasks/changes', limit=100),
+    'GET /tasks/{id}': request('GET', '/api/v1/tasks/{task_id}'),
+    'GET /tasks/{id}/prompts': request('GET', '/api/v1/tasks/{task_id}/prompts'),
+    'POST /tasks': request('POST', '/api/v1/tasks/', new_task),
+    'PUT /tasks/{id}': request('PUT', '/api/v1/tasks/{task_id}', new_task),
+    'POST /tasks/bulk': request('POST', '/api/v1/tasks/bulk', lambda rng: [new_task(rng) for _ in range(50)]),
+    'PATCH /tasks/bulk': update_task_bulk,
+    'DELETE /tasks/{id}': delete_task,
+    'DELETE /tasks/bulk': delete_task_bulk,
+    'GET /tasks/export': request('GET', '/api/v1/tasks/export'),
+    'POST /tasks/import': import_tasks,
+    'GET /prompts': request('GET', '/api/v1/prompts/'),
+    'POST /prompts/{id}/apply/{task_id}': request('POST', '/api/v1/prompts/{prompt_id}/apply/{task_id}'),
+    'POST /prompts/{id}/apply/{task_id}/stream': request('POST', '/api/v1/prompts/{prompt_id}/apply/{task_id}/stream'),
+    'POST /prompts/{id}/apply/{task_id}/jobs': enqueue_job,
+    'GET /prompts/jobs/{id}': read_job,
+    'GET /credits': request('GET', '/api/v1/credits/'),
+    'GET /credits/balance': request('GET', '/api/v1/credits/balance'),
+    'GET /events': first_event,
+    'GET /users': read_users,
+    'GET /users/{id}': read_user,
+    'POST /users': create_user,
+    'GET /metrics': lambda client, ctx: client.get('/metrics'),
+}
+
+# Scenarios that are too slow to run as many times as the rest
+REQUEST_SCALE = {
+    'POST /token': 0.1,
+    'POST /users': 0.1,
+    'GET /tasks?filter_name=completed&sort=date_completed&limit=1000': 0.2,
+    'GET /tasks/export': 0.05,
+    'POST /tasks/import': 0.2,
+}
+
+
+async def add_spare_tasks(client: httpx.AsyncClient, ctx: Context, requests: int, per_request: int = 1):
+    # Spread over the users, with enough extra that leftovers too few for a request don't run them out
+    per_user = (math.ceil(requests / len(ctx.user_ids)) + 1) * per_request
+    async with SessionLocal() as db:
+        for n, user_id in enumerate(ctx.user_ids):
+            data = [{**new_task(ctx.rng), 'owner_id': user_id} for _ in range(per_user)]
+            ctx.spare_task_ids[n] += (await db.scalars(insert(Task).returning(Task.id), data)).all()
+        await db.commit()
+
+async def add_jobs(client: httpx.AsyncClient, ctx: Context, requests: int):
+    # Reading doesn't use jobs up, so one will do
+    while not any(ctx.job_ids):
+        (await enqueue_job(client, ctx)).raise_for_status()
+
+# name -> function of (client, context, requests) run before a scenario is timed, for what it uses up
+SETUP = {
+    'DELETE /tasks/{id}': add_spare_tasks,
+    'DELETE /tasks/bulk': lambda client, ctx, requests: add_spare_tasks(client, ctx, requests, DELETE_BULK_SIZE),
+    'GET /prompts/jobs/{id}': add_jobs,
+}
+
+async def prepare_scenario(client: httpx.AsyncClient, ctx: Context, name: str, requests: int):
+    if name in SETUP:
+        await SETUP[name](client, ctx, requests)
+
+async def run_scenario(client: httpx.AsyncClient, ctx: Context, name: str, requests: int, concurrency: int, queries: list) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def one():
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                response = await SCENARIOS[name](client, ctx)
+                ok = response.status_code < 400
+            except httpx.HTTPError:
+                ok = False
+            latencies.append(time.perf_counter() - start)
+            errors += not ok
+
+    queries_before = queries[0]
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    elapsed = time.perf_counter() - start
+    return {
+        'requests': requests,
+        'errors': errors,
+        'requests_per_second': round(requests / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'queries_per_request': round((queries[0] - queries_before) / requests, 2),
+    }
+
+async def prepare(client: httpx.AsyncClient, user_ids: list, rng: random.Random) -> Context:
+    tokens = []
+    for n in range(len(user_ids)):
+        response = await client.post('/token', data={'username': BENCH_EMAIL.format(n), 'password': BENCH_PASSWORD})
+        response.raise_for_status()
+        tokens.append(response.json()['access_token'])
+    async with SessionLocal() as db:
+        task_ids = [
+            (await db.scalars(select(Task.id).where(Task.owner_id == user_id).order_by(Task.id).limit(TASK_SAMPLE))).all()
+            for user_id in user_ids
+        ]
+    prompt_ids = list((await catalog.get()).prompts)
+    return Context(user_ids, tokens, task_ids, prompt_ids, rng)
+
+async def main(args):
+    llm.async_client = FakeAsyncAnthropic(latency=args.llm_latency)
+    # A handful of users making hundreds of prompt runs would otherwise mostly measure 429s
+    ratelimit.LLM_RATE_LIMITS = False
+    async with SessionLocal() as db:
+        user_ids = await seed(db, args.users, args.tasks, args.transactions)
+
+    # Count every statement the server runs, to report queries per request
+    queries = [0]
+    def count_query(*_):
+        queries[0] += 1
+    event.listen(engine.sync_engine, 'before_cursor_execute', count_query)
+
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=args.port, log_level='warning'))
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    scenarios = args.scenario or list(SCENARIOS)
+    results = {}
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=f'http://127.0.0.1:{args.port}', timeout=60, limits=limits) as client:
+            ctx = await prepare(client, user_ids, random.Random(args.seed))
+            for name in scenarios:
+                requests = max(1, int(args.requests * REQUEST_SCALE.get(name, 1)))
+                await prepare_scenario(client, ctx, name, requests)
+                results[name] = await run_scenario(client, ctx, name, requests, args.concurrency, queries)
+                print(f'{name}: {json.dumps(results[name])}', file=sys.stderr)
+    finally:
+        server.should_exit = True
+        await serving
+
+    report = {
+        'commit': git_commit(),
+        'config': {key: getattr(args, key) for key in ('users', 'tasks', 'transactions', 'requests', 'concurrency', 'llm_latency', 'seed')},
+        'scenarios': results,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            sys.exit(compare(json.load(f), report, args.threshold))
+
+def compare(baseline: dict, report: dict, threshold: float) -> int:
+    """
+    Prints the change in each scenario's p95 and queries per request. Returns 1 if any p95 grew
+    by more than `threshold` percent, or any scenario runs more queries than before.
+    """
+    regressions = 0
+    print(f'\nCompared with {baseline.get("commit")}:')
+    for name, result in report['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if before is None:
+            continue
+        change = (result['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100 if before['p95_ms'] else 0
+        more_queries = result['queries_per_request'] > before['queries_per_request']
+        regressed = change > threshold or more_queries
+        regressions += regressed
+        print(f'{"FAIL" if regressed else "ok  "} {name}: p95 {before["p95_ms"]} -> {result["p95_ms"]} ms ({change:+.1f}%), '
+              f'queries {before["queries_per_request"]} -> {result["queries_per_request"]}')
+    return 1 if regressions else 0
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    parser.add_argument('--requests', type=int, default=500, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--llm-latency', type=float, default=0.5, help='seconds per fake LLM call')
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS), help='run only these, may be repeated')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--seed', type=int, default=1, help='random seed for picking users, tasks and prompts')
+    parser.add_argument('--output', help='write the report to this file')
+    parser.add_argument('--compare', help='baseline report to compare against')
+    parser.add_argument('--threshold', type=float, default=20, help='allowed p95 growth, in percent')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,99 @@
+"""
+Seeds benchmark users, each with tasks, prompt results and a credit history. Users that already
+exist are left as they are, so it is safe to run repeatedly. The first is made an admin, for the
+/users endpoints.
+
+    python -m benchmarks.seed --users 20 --tasks 10000 --transactions 2000
+"""
+from dotenv import load_dotenv
+load_dotenv()
+
+import argparse
+import asyncio
+from typing import List
+from sqlalchemy import select, text, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.auth import generate_salt, get_password_hash
+from app.database import SessionLocal, User
+from app.lib import credits
+
+BENCH_EMAIL = 'bench-{}@example.com'
+BENCH_PASSWORD = 'bench-password'
+
+SEED_TASKS = text("""
+    INSERT INTO tasks (description, location, priority, date_added, date_due, date_completed, status, categories, owner_id)
+    SELECT
+        (ARRAY['buy groceries', 'do laundry', 'call mom', 'pay rent', 'book dentist', 'renew passport', 'write report', 'clean garage'])[1 + i % 8] || ' #' || i,
+        (ARRAY['', 'home', 'work', 'store'])[1 + i % 4],
+        i % 6,
+        NOW() - make_interval(hours => i),
+        CASE WHEN i % 5 = 0 THEN NULL ELSE NOW() + make_interval(days => i % 60 - 20) END,
+        CASE WHEN i % 3 = 0 THEN NOW() - make_interval(hours => i % 500) END,
+        '',
+        ARRAY[(ARRAY['home', 'work', 'errands', 'health', 'finance'])[1 + i % 5]]::varchar[],
+        :owner_id
+    FROM generate_series(1, :count) AS i
+""")
+
+# A prompt result on every tenth task
+SEED_TASK_PROMPTS = text("""
+    INSERT INTO task_prompts (task_id, ai_prompt_id, result)
+    SELECT id, (SELECT min(id) FROM ai_prompts), 'Seeded result for ' || description
+    FROM tasks WHERE owner_id = :owner_id AND id % 10 = 0
+""")
+
+# A purchase of 20 credits for every 9 prompt runs, so balances stay positive
+SEED_TRANSACTIONS = text("""
+    INSERT INTO credit_transactions (user_id, amount, date, stripe_payment_id)
+    SELECT
+        :user_id,
+        CASE WHEN i % 10 = 0 THEN 20 ELSE -1 END,
+        NOW() - make_interval(hours => i),
+        CASE WHEN i % 10 = 0 THEN 'seed_' || i END
+    FROM generate_series(1, :count) AS i
+""")
+
+
+async def seed(db: AsyncSession, users: int, tasks: int, transactions: int) -> List[int]:
+    """
+    Returns the ids of the benchmark users.
+    """
+    salt = generate_salt()
+    hashed_password = await get_password_hash(BENCH_PASSWORD, salt)
+    user_ids = []
+    for n in range(users):
+        email = BENCH_EMAIL.format(n)
+        user_id = await db.scalar(select(User.id).where(User.email == email))
+        if user_id is None:
+            user = User(email=email, name=f'Bench {n}', hashed_password=hashed_password, salt=salt)
+            db.add(user)
+            await db.flush()
+            user_id = user.id
+            await db.execute(SEED_TASKS, {"owner_id": user_id, "count": tasks})
+            await db.execute(SEED_TASK_PROMPTS, {"owner_id": user_id})
+            await db.execute(SEED_TRANSACTIONS, {"user_id": user_id, "count": transactions})
+        user_ids.append(user_id)
+    if user_ids:
+        await db.execute(update(User).where(User.id == user_ids[0]).values(is_admin=True))
+    await credits.reconcile(db)
+    await db.commit()
+    await db.execute(text('ANALYZE'))
+    await db.commit()
+    return user_ids
+
+async def main(args):
+    async with SessionLocal() as db:
+        user_ids = await seed(db, args.users, args.tasks, args.transactions)
+    print(f'Seeded {len(user_ids)} users ({BENCH_EMAIL.format("N")} / {BENCH_PASSWORD})')
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--tasks', type=int, default=10000, help='tasks per user')
+    parser.add_argument('--transactions', type=int, default=2000, help='credit transactions per user')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,65 @@
+"""
+Fails if the query behind any listed endpoint falls back to a sequential scan on a large table,
+EXPLAINed for one of the seeded users.
+"""
+import json
+import pytest
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.api.v1.tasks import task_list_query
+from app.database import SessionLocal, Task, TaskPrompt, CreditTransaction
+
+pytestmark = pytest.mark.anyio
+
+CHECKED_TABLES = {'tasks', 'task_prompts', 'credit_transactions'}
+
+# endpoint -> function of (user_id, task_id) returning the query it runs
+QUERIES = {
+    'GET /tasks': lambda user_id, task_id: task_list_query(user_id, '', '')[0],
+    'GET /tasks?sort=date_due': lambda user_id, task_id: task_list_query(user_id, 'date_due', '')[0],
+    'GET /tasks?sort=date_added': lambda user_id, task_id: task_list_query(user_id, 'date_added', '')[0],
+    'GET /tasks?sort=priority': lambda user_id, task_id: task_list_query(user_id, 'priority', '')[0],
+    'GET /tasks?filter_name=today': lambda user_id, task_id: task_list_query(user_id, 'date_due', 'today')[0],
+    'GET /tasks?filter_name=week': lambda user_id, task_id: task_list_query(user_id, 'date_due', 'week')[0],
+    'GET /tasks?filter_name=high_priority': lambda user_id, task_id: task_list_query(user_id, 'priority', 'high_priority')[0],
+    'GET /tasks?filter_name=category:work': lambda user_id, task_id: task_list_query(user_id, '', 'category:work')[0],
+    'GET /tasks?filter_name=location:home': lambda user_id, task_id: task_list_query(user_id, '', 'location:home')[0],
+    'GET /tasks?filter_name=completed&sort=date_completed': lambda user_id, task_id: task_list_query(user_id, 'date_completed', 'completed')[0],
+    'GET /tasks?q=groceries': lambda user_id, task_id: task_list_query(user_id, 'rank', '', 'groceries')[0],
+    'GET /tasks?q=grocreies': lambda user_id, task_id: task_list_query(user_id, 'rank', '', 'grocreies')[0],
+    'GET /tasks?q=laundry&sort=date_due': lambda user_id, task_id: task_list_query(user_id, 'date_due', '', 'laundry')[0],
+    'GET /tasks/changes': lambda user_id, task_id: select(Task).where(Task.owner_id == user_id, Task.version > 0).order_by(Task.version),
+    'GET /tasks/{id}/prompts': lambda user_id, task_id: select(TaskPrompt).where(TaskPrompt.task_id == task_id).order_by(TaskPrompt.id),
+    'GET /credits': lambda user_id, task_id: select(CreditTransaction).where(CreditTransaction.user_id == user_id).order_by(CreditTransaction.id),
+}
+
+
+async def explain(db: AsyncSession, query) -> dict:
+    conn = await db.connection()
+    compiled = query.limit(100).compile(dialect=conn.dialect)
+    params = []
+    for name in compiled.positiontup:
+        processor = compiled.binds[name].type.bind_processor(conn.dialect)
+        value = compiled.params[name]
+        params.append(processor(value) if processor else value)
+    result = await conn.exec_driver_sql('EXPLAIN (FORMAT JSON) ' + compiled.string, tuple(params))
+    plan = result.scalar()
+    return (json.loads(plan) if isinstance(plan, str) else plan)[0]['Plan']
+
+def seq_scans(plan: dict):
+    if plan.get('Node Type') == 'Seq Scan' and plan.get('Relation Name') in CHECKED_TABLES:
+        yield plan['Relation Name']
+    for child in plan.get('Plans', []):
+        yield from seq_scans(child)
+
+
+@pytest.mark.parametrize('endpoint', list(QUERIES))
+async def test_no_seq_scan(endpoint, seeded):
+    user_id = seeded[len(seeded) // 2]
+    async with SessionLocal() as db:
+        task_id = await db.scalar(
+            select(TaskPrompt.task_id).join(Task, Task.id == TaskPrompt.task_id).where(Task.owner_id == user_id).limit(1)
+        )
+        plan = await explain(db, QUERIES[endpoint](user_id, task_id))
+    tables = sorted(set(seq_scans(plan)))
+    assert not tables, f'seq scan on {", ".join(tables)}'
@@ -0,0 +1,113 @@
+"""
+The LLM call policy (see app.lib.resilience) against benchmarks.fake_llm.FakeServer, a local server
+injecting errors and latency, through the real Anthropic client.
+"""
+import asyncio
+import time
+import pytest
+import uvicorn
+from anthropic import APIStatusError, APITimeoutError, AsyncAnthropic
+from app.lib import llm, resilience
+from benchmarks.fake_llm import FakeServer
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(scope='module')
+async def server():
+    server = FakeServer(latency=0.01)
+    uvicorn_server = uvicorn.Server(uvicorn.Config(server.app, host='127.0.0.1', port=0, log_level='warning'))
+    serving = asyncio.create_task(uvicorn_server.serve())
+    while not uvicorn_server.started:
+        await asyncio.sleep(0.05)
+    port = uvicorn_server.servers[0].sockets[0].getsockname()[1]
+    server.base_url = f'http://127.0.0.1:{port}'
+    yield server
+    uvicorn_server.should_exit = True
+    await serving
+
+@pytest.fixture(autouse=True)
+def upstream(server, monkeypatch):
+    server.fail()
+    server.retry_after = None
+    monkeypatch.setattr(llm, 'async_client', AsyncAnthropic(api_key='fake', base_url=server.base_url, max_retries=0))
+    monkeypatch.setattr(llm, 'policy', fresh_policy())
+
+def fresh_policy(**overrides) -> resilience.Policy:
+    # Short delays so the tests run quickly
+    options = dict(
+        retries=2,
+        base_delay=0.05,
+        max_delay=0.2,
+        retryable=llm.retryable,
+        retry_after=llm.retry_after,
+        breaker=resilience.CircuitBreaker(3, 0.5),
+    )
+    options.update(overrides)
+    return resilience.Policy(**options)
+
+async def call(timeout: float = 5):
+    """
+    Makes one uncached call, returning its result or exception and how long it took.
+    """
+    start = time.perf_counter()
+    try:
+        result = await llm.ainvoke('Hello', cache=False, timeout=timeout)
+    except Exception as e:
+        result = e
+    return result, time.perf_counter() - start
+
+
+async def test_retries_overloaded_and_server_errors(server):
+    server.fail(529, 500)
+    before = server.requests
+    result, _ = await call()
+    assert result == server.response
+    assert server.requests - before == 3
+
+async def test_does_not_retry_a_bad_request(server):
+    server.fail(400)
+    before = server.requests
+    result, _ = await call()
+    assert isinstance(result, APIStatusError)
+    assert server.requests - before == 1
+
+async def test_waits_for_retry_after(server):
+    server.retry_after = 0.5
+    server.fail(429)
+    result, elapsed = await call()
+    assert result == server.response
+    assert elapsed >= 0.5
+
+async def test_gives_up_at_the_deadline(server):
+    server.fail((200, 5))
+    result, elapsed = await call(timeout=0.5)
+    # Whichever of the client's own timeout and the policy's deadline fires first
+    assert isinstance(result, (asyncio.TimeoutError, APITimeoutError))
+    assert elapsed < 1
+
+async def test_circuit_opens_and_closes(server):
+    server.fail(*[500] * 10)
+    await call()
+    before = server.requests
+    result, _ = await call()
+    assert isinstance(result, resilience.CircuitOpen)
+    assert server.requests == before
+
+    # Once the cooldown is over, a successful trial call closes it
+    server.fail()
+    await asyncio.sleep(0.6)
+    result, _ = await call()
+    assert result == server.response
+    assert llm.policy.breaker.state == 'closed'
+
+async def test_hedges_a_slow_request(server, monkeypatch):
+    monkeypatch.setattr(llm, 'policy', fresh_policy(hedge=True))
+    for _ in range(llm.policy.latencies.min_samples):
+        await call()
+    server.fail((200, 3))
+    before = server.requests
+    result, elapsed = await call()
+    assert result == server.response
+    assert elapsed < 1
+    assert server.requests - before == 2
@@ -0,0 +1,19 @@
+from datetime import datetime
+from app.lib import pagination
+
+
+def test_cursor_round_trip():
+    position = {'sort': 'date_due', 'key': datetime(2026, 11, 1, 9, 0), 'id': 42}
+    assert pagination.decode_cursor(pagination.encode_cursor(position)) == position
+
+def test_cursor_values_must_fit_int4():
+    assert pagination.is_cursor_value(pagination.INT4_MAX, int)
+    assert pagination.is_cursor_value(pagination.INT4_MIN, int)
+    assert not pagination.is_cursor_value(pagination.INT4_MAX + 1, int)
+    assert not pagination.is_cursor_value(10 ** 400, (int, float))
+
+def test_cursor_values_must_have_the_right_type():
+    assert not pagination.is_cursor_value(True, int)
+    assert not pagination.is_cursor_value('1', int)
+    assert not pagination.is_cursor_value(1e308, int)
+    assert pagination.is_cursor_value(0.5, (int, float))
@@ -0,0 +1,45 @@
+"""
+Prompt instructions go upstream as a system block with a prompt caching marker, and the
+task-specific template is rendered into the user message.
+"""
+from datetime import datetime
+from types import SimpleNamespace
+import pytest
+from app.lib import llm, prompting
+from app.lib.catalog import Prompt
+from app.lib.templates import Template
+
+pytestmark = pytest.mark.anyio
+
+INSTRUCTIONS = 'You are a highly organized assistant. Break the task down into steps.'
+PROMPT = Prompt(
+    id=1, name='Action Plan', description='Create an Action Plan', cost=1, returns_json=False, cacheable=False,
+    instructions=INSTRUCTIONS,
+    template=Template('Task: "{task_description}" at {location}, due {date_due} ({categories}). Keep {this} as is.'),
+)
+TASK = SimpleNamespace(description='pay rent', location='home', categories=['finance', 'home'], date_due=datetime(2026, 11, 1, 9, 0))
+EXPECTED_MESSAGE = 'Task: "pay rent" at home, due 2026-11-01 09:00 UTC (finance, home). Keep {this} as is.'
+CACHED_SYSTEM = [{"type": "text", "text": INSTRUCTIONS, "cache_control": {"type": "ephemeral"}}]
+
+
+def test_template_renders_every_variable():
+    assert prompting.format_prompt(PROMPT, TASK) == EXPECTED_MESSAGE
+
+async def test_ainvoke_sends_cached_system_block(fake_llm):
+    await llm.ainvoke(EXPECTED_MESSAGE, cache=False, system=INSTRUCTIONS)
+    assert fake_llm.calls[-1]['messages'] == [{"role": "user", "content": EXPECTED_MESSAGE}]
+    assert fake_llm.calls[-1]['system'] == CACHED_SYSTEM
+
+async def test_ainvoke_without_instructions(fake_llm):
+    await llm.ainvoke(EXPECTED_MESSAGE, cache=False)
+    assert fake_llm.calls[-1]['messages'] == [{"role": "user", "content": EXPECTED_MESSAGE}]
+    assert 'system' not in fake_llm.calls[-1]
+
+async def test_astream_sends_cached_system_block(fake_llm):
+    text = ''.join([chunk async for chunk in llm.astream(EXPECTED_MESSAGE, system=INSTRUCTIONS)])
+    assert fake_llm.calls[-1]['messages'] == [{"role": "user", "content": EXPECTED_MESSAGE}]
+    assert fake_llm.calls[-1]['system'] == CACHED_SYSTEM
+    assert text == fake_llm.response
+
+def test_instructions_are_part_of_the_cache_key():
+    assert llm.cache_key(EXPECTED_MESSAGE, llm.DEFAULT_MODEL, 1000) != llm.cache_key(EXPECTED_MESSAGE, llm.DEFAULT_MODEL, 1000, INSTRUCTIONS)
@@ -0,0 +1,41 @@
+"""
+Fails if an endpoint runs more queries than its budget, such as when a change adds a lazy load
+per row. Each benchmarks.run scenario is called once to warm the auth and catalog caches, then
+measured.
+"""
+import pytest
+from benchmarks.run import SCENARIOS, prepare_scenario
+
+pytestmark = pytest.mark.anyio
+
+# Queries per request once the auth and catalog caches are warm
+QUERY_BUDGETS = {
+    'GET /': 0,
+    'POST /token': 1,
+    'GET /tasks': 2,
+    'GET /tasks?sort=date_due': 2,
+    'GET /tasks?filter_name=completed&sort=date_completed&limit=1000': 2,
+    'GET /tasks?skip=5000': 2,
+    'GET /tasks?q=grocreies': 3,
+    'GET /tasks/stats': 2,
+    'GET /tasks/changes?limit=100': 3,
+    'GET /tasks/{id}': 1,
+    'GET /tasks/{id}/prompts': 3,
+    'POST /tasks': 3,
+    'PUT /tasks/{id}': 4,
+    'POST /tasks/bulk': 2,
+    'PATCH /tasks/bulk': 2,
+    'GET /prompts': 0,
+    'POST /prompts/{id}/apply/{task_id}': 7,
+    'GET /credits': 1,
+    'GET /credits/balance': 1,
+}
+
+
+@pytest.mark.parametrize('name, budget', QUERY_BUDGETS.items(), ids=list(QUERY_BUDGETS))
+async def test_query_budget(name, budget, client, bench, fake_llm, query_budget):
+    await prepare_scenario(client, bench, name, 2)
+    await SCENARIOS[name](client, bench)
+    with query_budget(budget):
+        response = await SCENARIOS[name](client, bench)
+    assert response.status_code < 500
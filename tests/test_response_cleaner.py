@@ -0,0 +1,29 @@
+"""
+`llm.ResponseCleaner` against `llm.clean_response`, over random responses split at random points.
+"""
+import random
+from app.lib import llm
+
+PIECES = ['a', ' ', '\n', '`', '```', llm.MARKDOWN_FENCE, 'x y']
+
+
+def stream(cleaner: llm.ResponseCleaner, chunks) -> str:
+    return ''.join(cleaner.feed(chunk) for chunk in chunks) + cleaner.finish()
+
+def random_chunks(rng: random.Random, response: str) -> list:
+    cuts = sorted(rng.sample(range(len(response) + 1), min(len(response) + 1, rng.randrange(5))))
+    return [response[start:end] for start, end in zip([0] + cuts, cuts + [len(response)])]
+
+
+def test_matches_clean_response():
+    rng = random.Random(1)
+    for _ in range(5000):
+        body = ''.join(rng.choice(PIECES) for _ in range(rng.randrange(6)))
+        for response in (body, llm.MARKDOWN_FENCE + body + '```', llm.MARKDOWN_FENCE + body + '\n```'):
+            if response.startswith(llm.MARKDOWN_FENCE) and not response.endswith('```'):
+                continue  # Cut off, see below
+            assert stream(llm.ResponseCleaner(), random_chunks(rng, response)) == llm.clean_response(response), repr(response)
+
+def test_drops_opening_fence_of_cut_off_response():
+    # clean_response keeps it, which is why the stream endpoint saves the cleaned text
+    assert stream(llm.ResponseCleaner(), [llm.MARKDOWN_FENCE, 'Step 1']) == 'Step 1'
@@ -0,0 +1,19 @@
+"""
+`GET /tasks?q=` against the seeded descriptions (see benchmarks.seed).
+"""
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.mark.parametrize('q, word', [
+    ('groceries', 'groceries'),
+    ('grocreies', 'groceries'),
+    ('dentsit', 'dentist'),
+])
+async def test_search_tolerates_typos(q, word, client, bench):
+    response = await client.get('/api/v1/tasks/', params={'q': q}, headers=bench.headers(0))
+    assert response.status_code == 200
+    descriptions = [task['description'] for task in response.json()]
+    assert descriptions
+    assert all(word in description for description in descriptions)